@@ -0,0 +1,24 @@
+from contextlib import contextmanager
+
+from sqlalchemy import text
+
+from app import db
+
+
+@contextmanager
+def mysql_advisory_lock(lock_name, timeout_seconds=0):
+    """
+        MySQL GET_LOCK具名鎖, 跨進程互斥; yield是否取得鎖
+        鎖綁定於連線, 故使用獨立連線持有, 不受session commit歸還連線影響
+    """
+    connection = db.engine.connect()
+    try:
+        acquired = connection.execute(text("SELECT GET_LOCK(:lock_name, :timeout_seconds)"),
+                                      {"lock_name": lock_name, "timeout_seconds": timeout_seconds}).scalar() == 1
+        try:
+            yield acquired
+        finally:
+            if acquired:
+                connection.execute(text("SELECT RELEASE_LOCK(:lock_name)"), {"lock_name": lock_name})
+    finally:
+        connection.close()
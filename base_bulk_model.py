@@ -0,0 +1,91 @@
+from datetime import datetime
+
+from flask import has_request_context
+from sqlalchemy import UniqueConstraint, tuple_
+from sqlalchemy.dialects.mysql import insert as mysql_insert
+
+from app import db
+from app.util.current_user import current_user
+
+# createAndUpdateMixin之稽核欄位, Core語句不經ORM事件, 需顯式帶入
+AUDIT_CREATE_COLUMN_NAME_LIST = ["creator_name", "creator_account", "create_time"]
+AUDIT_UPDATE_COLUMN_NAME_LIST = ["updater_name", "updater_account", "last_update_time"]
+# 排程等無request之背景任務寫入之操作者
+SYSTEM_AUDIT_USER_NAME = "system"
+SYSTEM_AUDIT_USER_ACCOUNT = "system"
+
+
+def get_audit_params(table):
+    """
+        Core語句(批量INSERT/UPDATE)須顯式帶入之稽核欄位值, 只回傳table有之欄位;
+        新增時全部帶入, 修改時只取AUDIT_UPDATE_COLUMN_NAME_LIST
+    """
+    if has_request_context():
+        user_name, user_account = current_user.name, current_user.account
+    else:
+        user_name, user_account = SYSTEM_AUDIT_USER_NAME, SYSTEM_AUDIT_USER_ACCOUNT
+    now = datetime.now()
+    audit_params = {
+        "creator_name": user_name,
+        "creator_account": user_account,
+        "create_time": now,
+        "updater_name": user_name,
+        "updater_account": user_account,
+        "last_update_time": now,
+    }
+    return {_column_name: _value for _column_name, _value in audit_params.items() if _column_name in table.c}
+
+
+def get_audit_update_params(table):
+    return {_column_name: _value for _column_name, _value in get_audit_params(table).items()
+            if _column_name in AUDIT_UPDATE_COLUMN_NAME_LIST}
+
+
+class base_bulk_model(object):
+
+    @classmethod
+    def _get_unique_column_name_list(cls):
+        for _constraint in cls.__table__.constraints:
+            if isinstance(_constraint, UniqueConstraint):
+                return [_column.name for _column in _constraint.columns]
+        return [_column.name for _column in cls.__table__.primary_key.columns]
+
+    @classmethod
+    def _get_audit_params(cls):
+        return get_audit_params(cls.__table__)
+
+    @classmethod
+    def bulk_insert_or_update(cls, params_list, ignore_update=[]):
+        """
+            以單條INSERT ... ON DUPLICATE KEY UPDATE批量新增或修改,
+            回傳以唯一約束欄位值(tuple)為鍵之主鍵字典;
+            新增時寫入建立者與修改者稽核欄位, 修改時僅更新修改者稽核欄位
+        """
+        if len(params_list) == 0:
+            return {}
+
+        _table = cls.__table__
+        unique_column_name_list = cls._get_unique_column_name_list()
+
+        audit_params = cls._get_audit_params()
+        params_list = [{**_params, **audit_params} for _params in params_list]
+        insert_stmt = mysql_insert(_table)
+        update_values = {_column_name: insert_stmt.inserted[_column_name] for _column_name in params_list[0].keys()
+                         if _column_name not in ignore_update and _column_name not in AUDIT_CREATE_COLUMN_NAME_LIST}
+        if all(_column_name in AUDIT_UPDATE_COLUMN_NAME_LIST for _column_name in update_values):
+            update_values = {_table.c.id.name: _table.c.id}
+        db.session.execute(insert_stmt.on_duplicate_key_update(**update_values), params_list)
+
+        unique_key_list = list({tuple(_params[_column_name] for _column_name in unique_column_name_list)
+                                for _params in params_list})
+        unique_columns = [_table.c[_column_name] for _column_name in unique_column_name_list]
+        rst = db.session.execute(
+            _table.select().with_only_columns([_table.c.id] + unique_columns)
+                .where(tuple_(*unique_columns).in_(unique_key_list))).fetchall()
+        return {tuple(_row[1:]): _row[0] for _row in rst}
+
+    @classmethod
+    def bulk_delete_by_ids(cls, id_list):
+        if len(id_list) == 0:
+            return
+        db.session.execute(cls.__table__.delete().where(cls.__table__.c.id.in_(id_list)))
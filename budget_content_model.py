@@ -1,21 +1,94 @@
 import json
+from decimal import Decimal
 
 from sqlalchemy.ext.hybrid import hybrid_property
 
-from sqlalchemy import UniqueConstraint, event
+from sqlalchemy import UniqueConstraint, select, func
 from sqlalchemy.orm import validates, backref
 
 from app import db
 from app.model import createAndUpdateMixin, base_model
+from app.model.base_bulk_model import base_bulk_model
+from app.model.big_line_model import BigLine
 from app.model.budget_model import Budget
 from app.model.public_menu_model import PublicMenu
+from app.model.resource_version_model import ResourceVersion
+from app.model.small_line_model import SmallLine
 from app.model.station_model import Station
-from app.util.api_exceptions import ForbiddenError
-from app.util.current_user import current_user
-from app.util.enums import enum_confirm, enum_role
+from app.util.enums import enum_confirm
+from app.util.version_cache import VersionCache
 
 
-class BudgetContent(db.Model, createAndUpdateMixin, base_model):
+# 站點與線體屬參考資料, 以資料庫之參考資料版本號失效
+__station_small_line_index_cache = VersionCache()
+
+
+def get_station_small_line_name_dict_by_phase_id(phase_id):
+    """
+        階段站點索引: {station display_name: 第一個含該站點之small_line名稱}, 單次查詢建立, 參考資料版本號變更時重新載入
+    """
+    return __station_small_line_index_cache.get_or_load_by_version(
+        phase_id, ResourceVersion.get_reference_version(),
+        lambda: __load_station_small_line_name_dict_by_phase_id(phase_id))
+
+
+def __load_station_small_line_name_dict_by_phase_id(phase_id):
+    rst = db.session.query(Station.display_name, SmallLine.name) \
+        .join(Station._small_line) \
+        .join(SmallLine._big_line) \
+        .filter(BigLine.phase_id == phase_id) \
+        .order_by(BigLine.id, SmallLine.id) \
+        .all()
+    station_small_line_name_dict = {}
+    for display_name, small_line_name in rst:
+        station_small_line_name_dict.setdefault(display_name, small_line_name)
+    return station_small_line_name_dict
+
+
+def to_decimal(value):
+    """
+        資料庫讀出之值已為Decimal, 僅尚未flush之新值(如partnumber原始價格)需要轉換
+    """
+    if value is None or isinstance(value, Decimal):
+        return value
+    return Decimal(str(value))
+
+
+# 以資料庫之參考資料版本號失效, 任一進程異動PublicMenu並提交後各進程皆重新載入
+__public_menu_lookup_cache = VersionCache()
+
+
+def get_budget_category_dict():
+    """
+        {Category選單名稱: budget_category}, config預先解析, 參考資料版本號變更時重新載入
+    """
+    return __public_menu_lookup_cache.get_or_load_by_version(
+        "budget_category", ResourceVersion.get_reference_version(), __load_budget_category_dict)
+
+
+def get_user_code_dict():
+    """
+        {(payment, user_dept): user_code}, 同鍵以選單順序第一筆為準, 參考資料版本號變更時重新載入
+    """
+    return __public_menu_lookup_cache.get_or_load_by_version(
+        "user_code", ResourceVersion.get_reference_version(), __load_user_code_dict)
+
+
+def __load_budget_category_dict():
+    category_menu = PublicMenu.get_model_by_params(params={"menu_name": "Category"})._children
+    return {_category.menu_name: json.loads(_category.config).get("budget_category") for _category in category_menu}
+
+
+def __load_user_code_dict():
+    usercode_menu = PublicMenu.get_model_by_params(params={"menu_name": "UserCode"})._children
+    user_code_dict = {}
+    for _user_code in usercode_menu:
+        _config = json.loads(_user_code.config)
+        user_code_dict.setdefault((_config["payment"], _config["user_dept"]), _user_code.menu_name)
+    return user_code_dict
+
+
+class BudgetContent(db.Model, createAndUpdateMixin, base_model, base_bulk_model):
     __tablename__ = 'wms_budget_content'
     __table_args__ = (
         UniqueConstraint("partnumber_id", "budget_id"),
@@ -46,10 +119,10 @@ class BudgetContent(db.Model, createAndUpdateMixin, base_model):
                                 )
     total_purchase_qty = db.Column(db.Integer, nullable=False, default=0)
     on_hand_qty = db.Column(db.Integer, nullable=False)
-    unit_price = db.Column(db.String(16), nullable=False)
+    unit_price = db.Column(db.Numeric(16, 4), nullable=False)
     # TODO: to be validated
     unit_price_currency = db.Column(db.String(16), nullable=False)
-    exchange_rate_to_usd = db.Column(db.String(7), nullable=False)
+    exchange_rate_to_usd = db.Column(db.Numeric(12, 6), nullable=False)
 
     _budget_demand_list = db.relationship("BudgetDemand", cascade="all,delete")
     # _partnumber = db.relationship("Partnumber", backref=backref("_budget_content_list", cascade="all,delete"))
@@ -64,36 +137,20 @@ class BudgetContent(db.Model, createAndUpdateMixin, base_model):
 
     @hybrid_property
     def partnumber_category(self):
-        category_menu = PublicMenu.get_model_by_params(params={"menu_name": "Category"})._children
-        target_category = next(filter(
-            lambda _category: _category.menu_name == (self._partnumber._asset_category_item.item_name),
-            category_menu))
-        return json.loads(target_category.config).get("budget_category")
+        return get_budget_category_dict().get(self._partnumber._asset_category_item.item_name)
 
     @hybrid_property
     def user_code(self):
         if self.user_dept is None:
             return None
-        usercode_menu = PublicMenu.get_model_by_params(params={"menu_name": "UserCode"})._children
-        usercode_list = [{"user_code": user_code.menu_name, "config": json.loads(user_code.config)} for user_code in
-                         usercode_menu]
-        target_usercode = next(filter(
-            lambda user_code: user_code["config"]["payment"] == self._partnumber.payment_method
-                              and user_code["config"]["user_dept"] == self.user_dept, usercode_list))
-        return target_usercode.get("user_code")
+        return get_user_code_dict().get((self._partnumber.payment_method, self.user_dept))
 
     @hybrid_property
     def small_line_name(self):
         if self.partnumber_station_mapping_name == "ALL":
             return "ALL"
-        _big_lines = self._budget._phase._big_lines
-        for bl in _big_lines:
-            for sl in bl._small_lines:
-                target_station = Station.get_model_by_params(
-                    params={"small_line_id": sl.id, "display_name": self._partnumber._station_item.item_name}, check=False)
-                if target_station is not None:
-                    return sl.name
-        return "ALL"
+        station_small_line_name_dict = get_station_small_line_name_dict_by_phase_id(self._budget.phase_id)
+        return station_small_line_name_dict.get(self._partnumber._station_item.item_name, "ALL")
 
     @hybrid_property
     def reply_status(self):
@@ -115,18 +172,37 @@ class BudgetContent(db.Model, createAndUpdateMixin, base_model):
     def total_demand_qty(self):
         return sum([i.demand_qty for i in self._budget_demand_list])
 
+    @total_demand_qty.expression
+    def total_demand_qty(cls):
+        from app.model.budget_demand_model import BudgetDemand
+        return select([func.coalesce(func.sum(BudgetDemand.demand_qty), 0)]) \
+            .where(BudgetDemand.budget_content_id == cls.id) \
+            .as_scalar()
+
     @hybrid_property
     def usd_unit_price(self):
-        return float(self.unit_price) * float(self.exchange_rate_to_usd)
+        return to_decimal(self.unit_price) * to_decimal(self.exchange_rate_to_usd)
+
+    @usd_unit_price.expression
+    def usd_unit_price(cls):
+        return cls.unit_price * cls.exchange_rate_to_usd
 
     @hybrid_property
     def usd_additional(self):
         return self.usd_unit_price * self.total_purchase_qty
 
+    @usd_additional.expression
+    def usd_additional(cls):
+        return cls.usd_unit_price * cls.total_purchase_qty
+
     @hybrid_property
     def usd_total(self):
         return self.usd_unit_price * self.total_demand_qty
 
+    @usd_total.expression
+    def usd_total(cls):
+        return cls.usd_unit_price * cls.total_demand_qty
+
     @hybrid_property
     def demand_function_list(self):
         return [i.function for i in self._budget_demand_list]
@@ -161,34 +237,3 @@ class BudgetContent(db.Model, createAndUpdateMixin, base_model):
     def validate_addition(self, key, value):
         return value
 
-
-    def _forbidden_cross_function_modify(self):
-        # TODO: 需要校驗非通用物料跨function修改預算詳情
-        #     if self.partnumber_station_mapping_name is not "ALL" and this partnumber's station entity function attr not match current user function:
-        #         raise ForbiddenError(msg=f'budget content can not be modified while locked status')
-        if enum_role.LL in [_role.role_name for _role in current_user._roles]:
-            return
-        if not any(_func in self.demand_function_list for _func in current_user._functions):
-            raise ForbiddenError(msg=f'budget content can not be modified while function of user not in demand list')
-
-    def _budget_content_lock(self):
-        _budget = Budget.get_model_by_id(self.budget_id)
-        if _budget.is_lock:
-            raise ForbiddenError(msg=f'budget content can not be modified while locked status')
-
-
-@event.listens_for(BudgetContent, 'before_update')
-def budget_content_before_update_handler(mapper, connection, target: BudgetContent):
-    target._budget_content_lock()
-    target._forbidden_cross_function_modify()
-
-
-@event.listens_for(BudgetContent, 'before_insert')
-def budget_content_before_insert_handler(mapper, connection, target: BudgetContent):
-    target._budget_content_lock()
-
-
-@event.listens_for(BudgetContent, 'before_delete')
-def budget_content_before_delete_handler(mapper, connection, target: BudgetContent):
-    target._budget_content_lock()
-    target._forbidden_cross_function_modify()
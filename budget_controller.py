@@ -1,13 +1,24 @@
 from app.dto import base_resource_fields, delete_success_resp
 from app.dto.budget_dto import BudgetDTO
-from app.service import budget_service
+from app.dto.export_job_dto import ExportJobDTO
+from app.service import budget_service, resource_version_service
 from app.util.Api_base_resource import customResource
 from app.util.OAuthClient import require_oauth
+from app.util.conditional_request import etag_conditional_get
 from app.util.enums import enum_budget_type
 from app.util.pre_request import pre
 
 api = BudgetDTO.api
 
+
+# ETag版本號: 缺少budget_id時不做條件式GET, 交由參數校驗處理
+def _get_budget_version_by_args(args):
+    budget_id = args.get("budget_id", type=int)
+    if budget_id is None:
+        return None
+    return resource_version_service.get_budget_content_list_etag_version(budget_id)
+
+
 @api.route('')
 class Budget(customResource):
     @require_oauth('server')
@@ -44,10 +55,24 @@ class Budget(customResource):
         return delete_success_resp
 
 
+@api.route('/lock')
+class BudgetLock(customResource):
+    @require_oauth('server')
+    # @require_role(contains_any=enum_role.get_name_list())
+    @api.marshal_with(base_resource_fields)
+    @pre.catch(put=BudgetDTO.update_budget_is_lock_by_phase_req)
+    def put(self, params):
+        """
+            批量鎖定/解鎖階段下全部預算
+        """
+        budget_service.update_budget_is_lock_by_phase_id(params.get("phase_id"), params.get("is_lock"))
+
+
 @api.route('/page')
 class BudgetPage(customResource):
     @require_oauth('server')
     # @require_role(contains_any=enum_role.get_name_list())
+    @etag_conditional_get(lambda args: resource_version_service.get_budget_list_etag_version())
     @api.marshal_with(BudgetDTO.budget_pagination_resp_fields_model)
     @pre.catch(get=BudgetDTO.get_budget_paginate_by_params_req)
     def get(self, params):
@@ -62,10 +87,31 @@ class BudgetPage(customResource):
                                                            per_page=params['per_page'])
 
 
+@api.route('/cursor')
+class BudgetCursor(customResource):
+    @require_oauth('server')
+    # @require_role(contains_any=enum_role.get_name_list())
+    @api.marshal_with(BudgetDTO.budget_cursor_resp_fields_model)
+    @pre.catch(get=BudgetDTO.get_budget_cursor_by_params_req)
+    def get(self, params):
+        """
+            獲取預算游標分頁列表
+        """
+        if params.get("budget_type") is None:
+            type_list = enum_budget_type.get_value_list()
+            type_list.remove("EXTRA")
+            params["budget_type"] = type_list
+        return budget_service.get_budget_cursor_page_by_params(params,
+                                                               cursor=params.get("cursor"),
+                                                               per_page=params.get("per_page"),
+                                                               with_total=params.get("with_total"))
+
+
 @api.route('/menu')
 class BudgetMenu(customResource):
     @require_oauth('server')
     # @require_role(contains_any=enum_role.get_name_list())
+    @etag_conditional_get(lambda args: resource_version_service.get_budget_list_etag_version())
     @api.marshal_with(BudgetDTO.budget_menu_resp_fields_model)
     @pre.catch(get=BudgetDTO.get_budget_menu_req)
     def get(self, params):
@@ -75,17 +121,69 @@ class BudgetMenu(customResource):
         return {'budget_list': budget_service.get_budget_menu_by_params(params)}
 
 
+@api.route('/summary')
+class BudgetSummary(customResource):
+    @require_oauth('server')
+    # @require_role(contains_any=enum_role.get_name_list())
+    @api.marshal_with(BudgetDTO.budget_summary_resp_fields_model)
+    @pre.catch(get=BudgetDTO.get_budget_summary_req)
+    def get(self, params):
+        """
+            獲取預算USD匯總
+        """
+        return {'budget_summary_list': budget_service.get_budget_summary_by_params(params)}
+
+
+@api.route('/file')
+class BudgetFile(customResource):
+    @require_oauth('server')
+    # @require_role(contains_any=enum_role.get_name_list())
+    @pre.catch(get=BudgetDTO.get_budget_file_req)
+    def get(self, params):
+        """
+            獲取預算文件
+        """
+        return budget_service.get_budget_file_by_type_and_id(params.get("budget_id"),
+                                                             types=params.get("budget_type") or enum_budget_type.get_value_list())
+
+
+@api.route('/file/job')
+class BudgetFileJob(customResource):
+    @require_oauth('server')
+    # @require_role(contains_any=enum_role.get_name_list())
+    @api.marshal_with(ExportJobDTO.export_job_resp_fields_model)
+    @pre.catch(post=BudgetDTO.get_budget_file_req)
+    def post(self, params):
+        """
+            提交預算文件匯出任務
+        """
+        return {"export_job": budget_service.submit_budget_file_export_job_by_params(params)}
+
+
 @api.route('/synchronize/demand')
 class SynchronizeBudgetDemand(customResource):
     @require_oauth('server')
     # @require_role(contains_any=enum_role.get_name_list())
-    @api.marshal_with(base_resource_fields)
+    @api.marshal_with(BudgetDTO.budget_synchronize_demand_resp_fields_model)
     @pre.catch(put=BudgetDTO.synchronize_pilot_budget_content_and_demand_req)
     def put(self, params):
         """
             同步需求與數量
         """
-        budget_service.synchronize_pilot_budget_demand_with_stock(params.get("id"))
+        return {'summary': budget_service.synchronize_pilot_budget_demand_with_stock(params.get("id"))}
+
+
+@api.route('/synchronize/demand/preview')
+class SynchronizeBudgetDemandPreview(customResource):
+    @require_oauth('server')
+    # @require_role(contains_any=enum_role.get_name_list())
+    @api.marshal_with(BudgetDTO.budget_synchronize_demand_preview_resp_fields_model)
+    @pre.catch(get=BudgetDTO.preview_synchronize_pilot_budget_demand_req)
+    def get(self, params):
+        """
+            預覽同步需求與數量
+        """
+        return {'preview': budget_service.preview_synchronize_pilot_budget_demand_with_stock(params.get("budget_id"))}
 
 
 @api.route('/synchronize/unit_price_and_exchange_rate')
@@ -105,6 +203,7 @@ class SynchronizeBudgetUnitPriceAndExchangeRate(customResource):
 class BudgetContentList(customResource):
     @require_oauth('server')
     # @require_role(contains_any=enum_role.get_name_list())
+    @etag_conditional_get(_get_budget_version_by_args)
     @api.marshal_with(BudgetDTO.budget_content_list_resp_fields_model)
     @pre.catch(get=BudgetDTO.get_budget_content_list_req)
     def get(self, params):
@@ -4,6 +4,7 @@ from app.dto import base_resource_fields, BasePostStrRule, MyDateTimeFormat, Bas
     EnumField, BasePutBoolRule, base_paginate_req_params, base_resource_pagination_fields
 from app.util.enums import enum_budget_type
 from app.util.pre_request import Rule
+from app.dto.partnumber_dto import PartnumberDTO
 from app.dto.phase_dto import PhaseDTO
 from app.dto.product_dto import ProductDTO
 
@@ -32,9 +33,84 @@ class BudgetDTO(object):
         "name": fields.String(),
     }
 
+    budget_function_summary_resp_dto = {
+        "function": fields.String(),
+        "demand_qty": fields.Integer(),
+        "usd_total": fields.Float(),
+    }
+
+    budget_category_summary_resp_dto = {
+        "category": fields.String(),
+        "usd_total": fields.Float(),
+        "usd_additional": fields.Float(),
+    }
+
+    budget_summary_resp_dto = {
+        "budget_id": fields.Integer(),
+        "total_demand_qty": fields.Integer(),
+        "total_purchase_qty": fields.Integer(),
+        "usd_total": fields.Float(),
+        "usd_additional": fields.Float(),
+        "function_list": fields.List(fields.Nested(budget_function_summary_resp_dto)),
+        "category_list": fields.List(fields.Nested(budget_category_summary_resp_dto)),
+    }
+
+    budget_synchronize_count_resp_dto = {
+        "added": fields.Integer(),
+        "changed": fields.Integer(),
+        "removed": fields.Integer(),
+    }
+
+    budget_synchronize_demand_resp_dto = {
+        "budget_content": fields.Nested(budget_synchronize_count_resp_dto),
+        "budget_demand": fields.Nested(budget_synchronize_count_resp_dto),
+    }
+
+    budget_synchronize_preview_item_resp_dto = {
+        "partnumber_id": fields.Integer(),
+        "function": fields.String(),
+        "old_qty": fields.Integer(),
+        "qty": fields.Integer(),
+        "delta_qty": fields.Integer(),
+    }
+
+    budget_synchronize_preview_group_resp_dto = {
+        "added": fields.List(fields.Nested(budget_synchronize_preview_item_resp_dto)),
+        "changed": fields.List(fields.Nested(budget_synchronize_preview_item_resp_dto)),
+        "removed": fields.List(fields.Nested(budget_synchronize_preview_item_resp_dto)),
+    }
+
+    # qty為Total Purchase Q'ty, On Hand Q'ty另列
+    budget_synchronize_content_preview_item_resp_dto = {
+        "partnumber_id": fields.Integer(),
+        "old_qty": fields.Integer(),
+        "qty": fields.Integer(),
+        "delta_qty": fields.Integer(),
+        "old_on_hand_qty": fields.Integer(),
+        "on_hand_qty": fields.Integer(),
+    }
+
+    budget_synchronize_content_preview_group_resp_dto = {
+        "added": fields.List(fields.Nested(budget_synchronize_content_preview_item_resp_dto)),
+        "changed": fields.List(fields.Nested(budget_synchronize_content_preview_item_resp_dto)),
+        "removed": fields.List(fields.Nested(budget_synchronize_content_preview_item_resp_dto)),
+    }
+
+    budget_synchronize_demand_preview_resp_dto = {
+        "summary": fields.Nested(budget_synchronize_demand_resp_dto),
+        "budget_content": fields.Nested(budget_synchronize_content_preview_group_resp_dto),
+        "budget_demand": fields.Nested(budget_synchronize_preview_group_resp_dto),
+    }
+
+    budget_demand_resp_dto = {
+        "id": fields.Integer(),
+        "function": fields.String(),
+        "demand_qty": fields.Integer(),
+    }
+
     budget_content_resp_dto = {
         "id": fields.Integer(),
-        "partnumber": fields.Nested(PartnumberDTO., attribute="_partnumber"),
+        "partnumber": fields.Nested(PartnumberDTO.partnumber_resp_dto, attribute="_partnumber"),
         "small_line_name": fields.String(),
         "status": fields.Boolean(),
         "total_purchase_qty": fields.Integer(),
@@ -53,10 +129,13 @@ class BudgetDTO(object):
         "reason_demand": fields.String(),
         "on_hand_qty": fields.Integer(),
         "unit_price": fields.Float(),
+        "unit_price_currency": fields.String(),
+        "exchange_rate_to_usd": fields.Float(),
+        "usd_unit_price": fields.Float(),
+        "usd_total": fields.Float(),
         "station_type": EnumField(),
         "station_name": fields.String(),
-        "demand_list"
-        
+        "demand_list": fields.List(fields.Nested(budget_demand_resp_dto), attribute="_budget_demand_list"),
         "created_by": fields.String(attribute='creator_name'),
         "created_by_account": fields.String(attribute='creator_account'),
         "updated_by": fields.String(attribute='updater_name'),
@@ -81,6 +160,11 @@ class BudgetDTO(object):
         "is_lock": BasePutBoolRule(),
     }
 
+    update_budget_is_lock_by_phase_req = {
+        "phase_id": Rule(type=int, required=True),
+        "is_lock": Rule(type=bool, required=True),
+    }
+
     delete_budget_req = {
         "budget_id": Rule(type=int, dest='id', location='args', required=True),
     }
@@ -93,6 +177,14 @@ class BudgetDTO(object):
         }
     )
 
+    get_budget_cursor_by_params_req = {
+        "phase_id": Rule(type=int, location='args', required=False),
+        "type": Rule(type=str, location='args', trim=True, dest='budget_type', required=False, enum=enum_budget_type.get_value_list()),
+        "cursor": Rule(type=str, location='args', trim=True, required=False),
+        "per_page": Rule(type=int, location='args', required=False, default=15, gt=0, lte=100),
+        "with_total": Rule(type=bool, location='args', required=False, default=False),
+    }
+
     get_budget_menu_req = {
         "phase_id": Rule(type=int, location='args', required=True),
         "type": Rule(type=str, location='args', trim=True, dest='budget_type', required=False, enum=enum_budget_type.get_value_list()),
@@ -103,19 +195,53 @@ class BudgetDTO(object):
         "budget_id": Rule(type=int, dest='id', required=True),
     }
 
+    preview_synchronize_pilot_budget_demand_req = {
+        "budget_id": Rule(type=int, location='args', required=True),
+    }
+
     get_budget_content_list_req = {
         "budget_id": Rule(type=int, location='args', required=True),
         "purchase_method": Rule(type=str, multi=True, split=',', location='args', trim=True, required=False),
     }
 
+    get_budget_file_req = {
+        "budget_id": Rule(type=int, location='args', required=True),
+        "type": Rule(type=str, multi=True, split=',', location='args', trim=True, dest='budget_type', required=False,
+                     enum=enum_budget_type.get_value_list()),
+    }
+
+    get_budget_summary_req = {
+        "phase_id": Rule(type=int, location='args', required=False),
+        "budget_id": Rule(type=int, multi=True, split=',', location='args', required=False),
+    }
+
     __budget_pagination_resp_fields = deepcopy(base_resource_pagination_fields)
     __budget_pagination_resp_fields['result']['budget_list'] = fields.List(fields.Nested(budget_resp_dto), attribute="items")
     budget_pagination_resp_fields_model = api.model('獲取預算分頁列表', __budget_pagination_resp_fields)
 
+    __budget_cursor_resp_fields = deepcopy(base_resource_fields)
+    __budget_cursor_resp_fields['result']['budget_list'] = fields.List(fields.Nested(budget_resp_dto))
+    __budget_cursor_resp_fields['result']['has_next'] = fields.Boolean()
+    __budget_cursor_resp_fields['result']['next_cursor'] = fields.String()
+    __budget_cursor_resp_fields['result']['total'] = fields.Integer()
+    budget_cursor_resp_fields_model = api.model('獲取預算游標分頁列表', __budget_cursor_resp_fields)
+
     __budget_menu_resp_fields = deepcopy(base_resource_fields)
     __budget_menu_resp_fields['result']['budget_list'] = fields.List(fields.Nested(budget_menu_resp_dto))
     budget_menu_resp_fields_model = api.model('獲取預算選單', __budget_menu_resp_fields)
 
+    __budget_summary_resp_fields = deepcopy(base_resource_fields)
+    __budget_summary_resp_fields['result']['budget_summary_list'] = fields.List(fields.Nested(budget_summary_resp_dto))
+    budget_summary_resp_fields_model = api.model('獲取預算匯總', __budget_summary_resp_fields)
+
+    __budget_synchronize_demand_resp_fields = deepcopy(base_resource_fields)
+    __budget_synchronize_demand_resp_fields['result']['summary'] = fields.Nested(budget_synchronize_demand_resp_dto)
+    budget_synchronize_demand_resp_fields_model = api.model('同步需求與數量', __budget_synchronize_demand_resp_fields)
+
+    __budget_synchronize_demand_preview_resp_fields = deepcopy(base_resource_fields)
+    __budget_synchronize_demand_preview_resp_fields['result']['preview'] = fields.Nested(budget_synchronize_demand_preview_resp_dto)
+    budget_synchronize_demand_preview_resp_fields_model = api.model('預覽同步需求與數量', __budget_synchronize_demand_preview_resp_fields)
+
     __budget_resp_resp_fields = deepcopy(base_resource_fields)
     __budget_resp_resp_fields['result']['budget'] = fields.Nested(budget_resp_dto)
     budget_resp_resp_fields_model = api.model('獲取預算', __budget_resp_resp_fields)
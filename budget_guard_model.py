@@ -0,0 +1,183 @@
+from sqlalchemy import event
+from sqlalchemy.orm import Session, object_session
+
+from app.model.budget_model import Budget
+from app.model.budget_content_model import BudgetContent
+from app.model.budget_demand_model import BudgetDemand
+from app.util.api_exceptions import ForbiddenError
+from app.util.current_user import current_user
+from app.util.enums import enum_role
+
+BUDGET_GUARD_CONTEXT_KEY = "budget_guard_context"
+
+
+class BudgetGuardContext(object):
+    """
+        預算鎖定與使用者權限之校驗上下文, 同一unit of work內每個預算只查詢一次, commit或rollback後失效
+    """
+
+    def __init__(self, session):
+        self.__session = session
+        self.__is_system = False
+        self.__is_ll = None
+        self.__user_function_list = None
+        self.__budget_is_lock_dict = {}
+        self.__budget_content_budget_id_dict = {}
+
+    @classmethod
+    def of_session(cls, session):
+        if BUDGET_GUARD_CONTEXT_KEY not in session.info:
+            session.info[BUDGET_GUARD_CONTEXT_KEY] = cls(session)
+        return session.info[BUDGET_GUARD_CONTEXT_KEY]
+
+    @classmethod
+    def clear(cls, session):
+        session.info.pop(BUDGET_GUARD_CONTEXT_KEY, None)
+
+    # 排程等無使用者之背景任務以系統身份執行, 跳過角色與function校驗, 鎖定校驗照常
+    def run_as_system(self):
+        self.__is_system = True
+
+    def is_ll(self):
+        if self.__is_system:
+            return True
+        if self.__is_ll is None:
+            self.__is_ll = enum_role.LL in [_role.role_name for _role in current_user._roles]
+        return self.__is_ll
+
+    def get_user_function_list(self):
+        if self.__user_function_list is None:
+            self.__user_function_list = list(current_user._functions)
+        return self.__user_function_list
+
+    def forget_budget(self, budget_id_list):
+        for _budget_id in budget_id_list:
+            self.__budget_is_lock_dict.pop(_budget_id, None)
+
+    def forget_all_budget(self):
+        self.__budget_is_lock_dict.clear()
+
+    def load_budget_lock(self, budget_id_list):
+        missing_budget_id_set = {_id for _id in budget_id_list
+                                 if _id is not None and _id not in self.__budget_is_lock_dict}
+        if len(missing_budget_id_set) > 0:
+            self.__budget_is_lock_dict.update(dict(
+                self.__session.query(Budget.id, Budget.is_lock).filter(Budget.id.in_(missing_budget_id_set)).all()))
+
+    def load_budget_content_budget_id(self, budget_content_id_list):
+        missing_budget_content_id_set = {_id for _id in budget_content_id_list
+                                         if _id is not None and _id not in self.__budget_content_budget_id_dict}
+        if len(missing_budget_content_id_set) > 0:
+            self.__budget_content_budget_id_dict.update(dict(
+                self.__session.query(BudgetContent.id, BudgetContent.budget_id)
+                    .filter(BudgetContent.id.in_(missing_budget_content_id_set)).all()))
+
+    def get_budget_id_by_budget_content_id(self, budget_content_id):
+        self.load_budget_content_budget_id([budget_content_id])
+        return self.__budget_content_budget_id_dict.get(budget_content_id)
+
+    def is_budget_lock(self, budget_id):
+        self.load_budget_lock([budget_id])
+        return self.__budget_is_lock_dict.get(budget_id, False)
+
+    def validate_budget_content_unlock(self, budget_id):
+        if self.is_budget_lock(budget_id):
+            raise ForbiddenError(msg=f'budget content can not be modified while locked status')
+
+    def validate_budget_demand_unlock(self, budget_id):
+        if self.is_budget_lock(budget_id):
+            raise ForbiddenError(msg=f'budget demand can not be modified while locked status')
+
+    def validate_budget_content_function(self, demand_function_list):
+        # TODO: 需要校驗非通用物料跨function修改預算詳情
+        #     if self.partnumber_station_mapping_name is not "ALL" and this partnumber's station entity function attr not match current user function:
+        #         raise ForbiddenError(msg=f'budget content can not be modified while locked status')
+        if self.is_ll():
+            return
+        if not any(_func in demand_function_list for _func in self.get_user_function_list()):
+            raise ForbiddenError(msg=f'budget content can not be modified while function of user not in demand list')
+
+    def validate_budget_demand_function(self, function):
+        if self.is_ll():
+            return
+        if function not in self.get_user_function_list():
+            raise ForbiddenError(
+                msg=f'budget demand can not be modified while function of user not match demand function')
+
+    # 整批校驗一次flush之預算詳情與需求, 鎖定狀態與詳情所屬預算各以一條IN查詢取得
+    def validate_flush(self, session):
+        self.forget_budget([_obj.id for _obj in session.dirty if isinstance(_obj, Budget)])
+
+        new_budget_content_list = [_obj for _obj in session.new if isinstance(_obj, BudgetContent)]
+        modify_budget_content_list = [_obj for _obj in session.dirty if isinstance(_obj, BudgetContent)] \
+                                     + [_obj for _obj in session.deleted if isinstance(_obj, BudgetContent)]
+        new_budget_demand_list = [_obj for _obj in session.new if isinstance(_obj, BudgetDemand)]
+        modify_budget_demand_list = [_obj for _obj in session.dirty if isinstance(_obj, BudgetDemand)] \
+                                    + [_obj for _obj in session.deleted if isinstance(_obj, BudgetDemand)]
+        if len(new_budget_content_list) + len(modify_budget_content_list) \
+                + len(new_budget_demand_list) + len(modify_budget_demand_list) == 0:
+            return
+
+        self.load_budget_content_budget_id(
+            [_demand.budget_content_id for _demand in new_budget_demand_list + modify_budget_demand_list])
+        budget_demand_budget_id_list = [self.__get_budget_demand_budget_id(_demand)
+                                        for _demand in new_budget_demand_list + modify_budget_demand_list]
+        self.load_budget_lock([_content.budget_id for _content in new_budget_content_list + modify_budget_content_list]
+                              + budget_demand_budget_id_list)
+        demand_function_dict = self.__load_demand_function_dict(modify_budget_content_list)
+
+        for _content in new_budget_content_list:
+            self.validate_budget_content_unlock(_content.budget_id)
+        for _content in modify_budget_content_list:
+            self.validate_budget_content_unlock(_content.budget_id)
+            self.validate_budget_content_function(demand_function_dict.get(_content.id, []))
+        for _budget_id in budget_demand_budget_id_list:
+            self.validate_budget_demand_unlock(_budget_id)
+        for _demand in modify_budget_demand_list:
+            self.validate_budget_demand_function(_demand.function)
+
+    def __get_budget_demand_budget_id(self, budget_demand):
+        if budget_demand.budget_content_id is None and budget_demand._budget_content is not None:
+            return budget_demand._budget_content.budget_id
+        return self.get_budget_id_by_budget_content_id(budget_demand.budget_content_id)
+
+    def __load_demand_function_dict(self, budget_content_list):
+        if self.is_ll():
+            return {}
+        # 已載入之需求清單以記憶體為準, 其餘以一條查詢取得
+        demand_function_dict = {_content.id: _content.demand_function_list for _content in budget_content_list
+                                if '_budget_demand_list' in _content.__dict__}
+        unloaded_budget_content_id_list = [_content.id for _content in budget_content_list
+                                           if _content.id is not None and _content.id not in demand_function_dict]
+        if len(unloaded_budget_content_id_list) > 0:
+            for _budget_content_id, _function in self.__session.query(BudgetDemand.budget_content_id, BudgetDemand.function) \
+                    .filter(BudgetDemand.budget_content_id.in_(unloaded_budget_content_id_list)).all():
+                demand_function_dict.setdefault(_budget_content_id, []).append(_function)
+        return demand_function_dict
+
+
+def budget_guard_before_flush_handler(session, flush_context, instances):
+    BudgetGuardContext.of_session(session).validate_flush(session)
+
+
+# 初版預算鎖定會連帶以Core語句更新追加預算, 已快取之鎖定狀態一併失效
+def budget_guard_budget_after_update_handler(mapper, connection, target: Budget):
+    session = object_session(target)
+    if session is not None:
+        BudgetGuardContext.of_session(session).forget_all_budget()
+
+
+def budget_guard_after_transaction_handler(session):
+    BudgetGuardContext.clear(session)
+
+
+# 由app.model套件初始化時呼叫, 模型全部載入後才註冊, 避免模型模組互相import; 重複呼叫不會重複註冊
+def register_budget_guard_listener():
+    for _target, _identifier, _handler in [
+        (Session, 'before_flush', budget_guard_before_flush_handler),
+        (Budget, 'after_update', budget_guard_budget_after_update_handler),
+        (Session, 'after_commit', budget_guard_after_transaction_handler),
+        (Session, 'after_rollback', budget_guard_after_transaction_handler),
+    ]:
+        if not event.contains(_target, _identifier, _handler):
+            event.listen(_target, _identifier, _handler)
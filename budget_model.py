@@ -1,4 +1,4 @@
-from sqlalchemy import UniqueConstraint, event
+from sqlalchemy import UniqueConstraint, event, inspect
 from sqlalchemy.orm import backref, validates
 
 from app import db
@@ -77,14 +77,16 @@ class Budget(db.Model, createAndUpdateMixin, base_model):
                 raise ForbiddenError(msg=f'extra budget can not bind on locked pilot budget')
 
 
+    # 僅在is_lock實際異動時以單條UPDATE同步全部追加預算
     def _sync_extra_budget_is_lock_when_update(self, connection):
-        if self.budget_type == enum_budget_type.PILOT:
-            _extra_budget_list = Budget.get_model_list_by_params({"pilot_budget_id": self.id})
-            for extra_budget in _extra_budget_list:
-                connection.execute(
-                    Budget.__table__.update().
-                        where(Budget.__table__.c.id == extra_budget.id).
-                        values(is_lock=self.is_lock))
+        if self.budget_type != enum_budget_type.PILOT:
+            return
+        if not inspect(self).attrs.is_lock.history.has_changes():
+            return
+        connection.execute(
+            Budget.__table__.update().
+                where(Budget.__table__.c.pilot_budget_id == self.id).
+                values(is_lock=self.is_lock))
 
 
 @event.listens_for(Budget, 'before_update')
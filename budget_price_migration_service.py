@@ -0,0 +1,121 @@
+import click
+from flask.cli import AppGroup
+from sqlalchemy import text
+
+from app import db
+
+# wms_budget_content.unit_price: VARCHAR(16) -> DECIMAL(16,4)
+# wms_budget_content.exchange_rate_to_usd: VARCHAR(7) -> DECIMAL(12,6)
+BACKFILL_BATCH_SIZE = 5000
+# 須可無損轉換: 整數位不超過precision - scale, 小數位不超過scale(尾端0除外), 否則CAST會四捨五入或溢位
+UNIT_PRICE_PATTERN = r'^-?0*[0-9]{1,12}(\.[0-9]{1,4}0*)?$'
+EXCHANGE_RATE_TO_USD_PATTERN = r'^-?0*[0-9]{1,6}(\.[0-9]{1,6}0*)?$'
+# 回滾後之字串寬度
+UNIT_PRICE_STRING_LENGTH = 16
+EXCHANGE_RATE_TO_USD_STRING_LENGTH = 7
+UNIT_PRICE_STRING_SQL = "TRIM(TRAILING '.' FROM TRIM(TRAILING '0' FROM CAST(unit_price AS CHAR)))"
+EXCHANGE_RATE_TO_USD_STRING_SQL = "TRIM(TRAILING '.' FROM TRIM(TRAILING '0' FROM CAST(exchange_rate_to_usd AS CHAR)))"
+
+
+# 非數值, 或整數位/小數位超出DECIMAL(16,4)/DECIMAL(12,6)之舊資料
+def get_non_numeric_budget_content_price_list():
+    return db.session.execute(text(
+        "SELECT id, unit_price, exchange_rate_to_usd FROM wms_budget_content "
+        "WHERE TRIM(unit_price) NOT REGEXP :unit_price_pattern "
+        "OR TRIM(exchange_rate_to_usd) NOT REGEXP :exchange_rate_to_usd_pattern"),
+        {"unit_price_pattern": UNIT_PRICE_PATTERN,
+         "exchange_rate_to_usd_pattern": EXCHANGE_RATE_TO_USD_PATTERN}).fetchall()
+
+
+# 轉回字串後超出VARCHAR(16)/VARCHAR(7)之資料
+def get_overflow_string_budget_content_price_list():
+    return db.session.execute(text(
+        "SELECT id, unit_price, exchange_rate_to_usd FROM wms_budget_content "
+        f"WHERE CHAR_LENGTH({UNIT_PRICE_STRING_SQL}) > :unit_price_length "
+        f"OR CHAR_LENGTH({EXCHANGE_RATE_TO_USD_STRING_SQL}) > :exchange_rate_to_usd_length"),
+        {"unit_price_length": UNIT_PRICE_STRING_LENGTH,
+         "exchange_rate_to_usd_length": EXCHANGE_RATE_TO_USD_STRING_LENGTH}).fetchall()
+
+
+def __backfill_by_id_range(update_sql):
+    min_id, max_id = db.session.execute(text("SELECT MIN(id), MAX(id) FROM wms_budget_content")).first()
+    if min_id is None:
+        return
+    for start_id in range(min_id, max_id + 1, BACKFILL_BATCH_SIZE):
+        db.session.execute(text(update_sql), {"start_id": start_id, "end_id": start_id + BACKFILL_BATCH_SIZE})
+        db.session.commit()
+
+
+# 1.檢查無法轉換之舊資料 2.新增DECIMAL欄位 3.分批回填 4.替換原欄位
+def upgrade_budget_content_price_to_decimal():
+    non_numeric_list = get_non_numeric_budget_content_price_list()
+    if len(non_numeric_list) > 0:
+        raise click.ClickException(f'{len(non_numeric_list)} budget content price can not convert to decimal, '
+                                   f'first ids: {[_row[0] for _row in non_numeric_list[:20]]}')
+
+    db.session.execute(text(
+        "ALTER TABLE wms_budget_content "
+        "ADD COLUMN unit_price_decimal DECIMAL(16,4) NULL, "
+        "ADD COLUMN exchange_rate_to_usd_decimal DECIMAL(12,6) NULL"))
+    __backfill_by_id_range(
+        "UPDATE wms_budget_content "
+        "SET unit_price_decimal = CAST(TRIM(unit_price) AS DECIMAL(16,4)), "
+        "exchange_rate_to_usd_decimal = CAST(TRIM(exchange_rate_to_usd) AS DECIMAL(12,6)) "
+        "WHERE id >= :start_id AND id < :end_id")
+    db.session.execute(text(
+        "ALTER TABLE wms_budget_content "
+        "DROP COLUMN unit_price, "
+        "DROP COLUMN exchange_rate_to_usd, "
+        "CHANGE COLUMN unit_price_decimal unit_price DECIMAL(16,4) NOT NULL, "
+        "CHANGE COLUMN exchange_rate_to_usd_decimal exchange_rate_to_usd DECIMAL(12,6) NOT NULL"))
+    db.session.commit()
+
+
+# 回滾: 以去除尾端0之字串寫回原VARCHAR欄位, 任一值超出原欄位寬度則中止, 不截斷
+def downgrade_budget_content_price_to_string():
+    overflow_list = get_overflow_string_budget_content_price_list()
+    if len(overflow_list) > 0:
+        raise click.ClickException(f'{len(overflow_list)} budget content price can not fit the string columns, '
+                                   f'first ids: {[_row[0] for _row in overflow_list[:20]]}')
+
+    db.session.execute(text(
+        "ALTER TABLE wms_budget_content "
+        f"ADD COLUMN unit_price_string VARCHAR({UNIT_PRICE_STRING_LENGTH}) NULL, "
+        f"ADD COLUMN exchange_rate_to_usd_string VARCHAR({EXCHANGE_RATE_TO_USD_STRING_LENGTH}) NULL"))
+    __backfill_by_id_range(
+        "UPDATE wms_budget_content "
+        f"SET unit_price_string = {UNIT_PRICE_STRING_SQL}, "
+        f"exchange_rate_to_usd_string = {EXCHANGE_RATE_TO_USD_STRING_SQL} "
+        "WHERE id >= :start_id AND id < :end_id")
+    db.session.execute(text(
+        "ALTER TABLE wms_budget_content "
+        "DROP COLUMN unit_price, "
+        "DROP COLUMN exchange_rate_to_usd, "
+        f"CHANGE COLUMN unit_price_string unit_price VARCHAR({UNIT_PRICE_STRING_LENGTH}) NOT NULL, "
+        f"CHANGE COLUMN exchange_rate_to_usd_string exchange_rate_to_usd VARCHAR({EXCHANGE_RATE_TO_USD_STRING_LENGTH}) NOT NULL"))
+    db.session.commit()
+
+
+budget_price_migration_cli = AppGroup('budget-price-migration', help='預算單價與匯率欄位DECIMAL遷移')
+
+
+@budget_price_migration_cli.command('check')
+def check_budget_content_price_command():
+    non_numeric_list = get_non_numeric_budget_content_price_list()
+    for _row in non_numeric_list:
+        click.echo(f'id={_row[0]} unit_price={_row[1]!r} exchange_rate_to_usd={_row[2]!r}')
+    click.echo(f'{len(non_numeric_list)} budget content price can not convert to decimal without loss '
+               '(non numeric, more than 12 integer digits or more than 4 decimals for unit price, '
+               'more than 6 integer digits or more than 6 decimals for exchange rate)')
+
+
+@budget_price_migration_cli.command('upgrade')
+def upgrade_budget_content_price_command():
+    upgrade_budget_content_price_to_decimal()
+    click.echo('budget content price migrated to decimal')
+
+
+@budget_price_migration_cli.command('downgrade')
+def downgrade_budget_content_price_command():
+    downgrade_budget_content_price_to_string()
+    click.echo('budget content price rolled back to string')
@@ -0,0 +1,31 @@
+from app import db
+from app.model import base_model
+
+
+class BudgetResyncState(db.Model, base_model):
+    """
+        初版預算背景同步狀態: 記錄上次同步時來源EQ任務與價格之指紋, 指紋不變則跳過
+    """
+    __tablename__ = 'wms_budget_resync_state'
+
+    id = db.Column(db.Integer, primary_key=True)
+    budget_id = db.Column(db.ForeignKey("wms_budget.id", ondelete="CASCADE"), nullable=False, unique=True)
+    fingerprint = db.Column(db.String(64), nullable=False)
+    last_sync_time = db.Column(db.DateTime, nullable=False)
+
+
+class BudgetResyncRun(db.Model, base_model):
+    """
+        初版預算背景同步之每輪執行紀錄
+    """
+    __tablename__ = 'wms_budget_resync_run'
+
+    id = db.Column(db.Integer, primary_key=True)
+    start_time = db.Column(db.DateTime, nullable=False)
+    finish_time = db.Column(db.DateTime, nullable=True)
+    duration_ms = db.Column(db.Integer, nullable=True)
+    budget_count = db.Column(db.Integer, nullable=False, default=0)
+    synced_count = db.Column(db.Integer, nullable=False, default=0)
+    skipped_count = db.Column(db.Integer, nullable=False, default=0)
+    busy_count = db.Column(db.Integer, nullable=False, default=0)
+    failed_count = db.Column(db.Integer, nullable=False, default=0)
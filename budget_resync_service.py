@@ -0,0 +1,169 @@
+import hashlib
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+import click
+from flask import current_app
+from flask.cli import AppGroup
+
+from app import db
+from app.model.budget_content_model import BudgetContent
+from app.model.budget_model import Budget
+from app.model.budget_resync_model import BudgetResyncRun, BudgetResyncState
+from app.model.main_task_model import MainTask
+from app.model.partnumber_model import Partnumber
+from app.service import budget_service, exchange_rate_service, resource_version_service
+from app.util.advisory_lock import mysql_advisory_lock
+from app.util.enums import enum_budget_type, enum_main_task_status_type
+
+BUDGET_RESYNC_INTERVAL_SECONDS = 60 * 60
+BUDGET_RESYNC_MAX_WORKERS = 4
+# 多進程各自啟動排程, 同一時間只有一個進程執行整輪同步
+BUDGET_RESYNC_RUN_LOCK_NAME = "wms_budget_resync_run"
+
+BUDGET_RESYNC_RESULT_SYNCED = "SYNCED"
+BUDGET_RESYNC_RESULT_SKIPPED = "SKIPPED"
+BUDGET_RESYNC_RESULT_BUSY = "BUSY"
+BUDGET_RESYNC_RESULT_FAILED = "FAILED"
+
+__scheduler_lock = threading.Lock()
+__scheduler_stop_event = threading.Event()
+__scheduler_thread = None
+
+
+# 於app建立後呼叫, 以daemon執行緒定期同步全部未鎖定之初版預算, 重複呼叫不會重複啟動
+def start_budget_resync_scheduler(app, interval_seconds=BUDGET_RESYNC_INTERVAL_SECONDS):
+    global __scheduler_thread
+    with __scheduler_lock:
+        if __scheduler_thread is not None and __scheduler_thread.is_alive():
+            return __scheduler_thread
+        __scheduler_stop_event.clear()
+        __scheduler_thread = threading.Thread(target=__run_budget_resync_scheduler,
+                                              args=(app, interval_seconds),
+                                              name="budget_resync_scheduler",
+                                              daemon=True)
+        __scheduler_thread.start()
+        return __scheduler_thread
+
+
+def stop_budget_resync_scheduler():
+    __scheduler_stop_event.set()
+
+
+# 執行一輪同步並記錄執行指標; 其他進程正在執行時回傳None
+def run_budget_resync(max_workers=BUDGET_RESYNC_MAX_WORKERS):
+    with mysql_advisory_lock(BUDGET_RESYNC_RUN_LOCK_NAME) as acquired:
+        if not acquired:
+            return None
+
+        start_monotonic = time.monotonic()
+        resync_run = BudgetResyncRun(start_time=datetime.now())
+        db.session.add(resync_run)
+        db.session.commit()
+
+        # 來源EQ任務仍在進行中(子任務未全部通過)之預算不可同步, 不列入本輪
+        budget_id_list = [_id for (_id,) in db.session.query(Budget.id)
+            .join(MainTask, MainTask.id == Budget.source_main_eq_task_id)
+            .filter(Budget.budget_type == enum_budget_type.PILOT,
+                    Budget.is_lock.is_(False),
+                    MainTask.task_status != enum_main_task_status_type.STARTED)
+            .order_by(Budget.id)
+            .all()]
+        app = current_app._get_current_object()
+        with ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="budget_resync") as executor:
+            result_list = list(executor.map(lambda _budget_id: __resync_budget(app, _budget_id), budget_id_list))
+
+        resync_run.finish_time = datetime.now()
+        resync_run.duration_ms = int((time.monotonic() - start_monotonic) * 1000)
+        resync_run.budget_count = len(budget_id_list)
+        resync_run.synced_count = result_list.count(BUDGET_RESYNC_RESULT_SYNCED)
+        resync_run.skipped_count = result_list.count(BUDGET_RESYNC_RESULT_SKIPPED)
+        resync_run.busy_count = result_list.count(BUDGET_RESYNC_RESULT_BUSY)
+        resync_run.failed_count = result_list.count(BUDGET_RESYNC_RESULT_FAILED)
+        db.session.commit()
+        return resync_run
+
+
+def __run_budget_resync_scheduler(app, interval_seconds):
+    while not __scheduler_stop_event.wait(interval_seconds):
+        with app.app_context():
+            try:
+                run_budget_resync()
+            except Exception:
+                app.logger.exception('budget resync run failed')
+            finally:
+                db.session.remove()
+
+
+# 1.以具名鎖與手動同步互斥, 鎖被占用則略過本輪
+# 2.來源EQ任務於列出預算後重新開始(STARTED)則略過, 不視為失敗
+# 3.來源EQ任務內容版本與價格指紋未變則略過
+def __resync_budget(app, budget_id):
+    with app.app_context():
+        try:
+            with mysql_advisory_lock(budget_service.get_budget_sync_lock_name(budget_id)) as acquired:
+                if not acquired:
+                    return BUDGET_RESYNC_RESULT_BUSY
+
+                pilot_budget = Budget.get_model_by_id(budget_id)
+                if pilot_budget is None or pilot_budget.is_lock:
+                    return BUDGET_RESYNC_RESULT_SKIPPED
+                source_main_eq_task = MainTask.get_model_by_id(pilot_budget.source_main_eq_task_id)
+                if source_main_eq_task is None or \
+                        source_main_eq_task.task_status == enum_main_task_status_type.STARTED:
+                    return BUDGET_RESYNC_RESULT_SKIPPED
+
+                resync_state = BudgetResyncState.query.filter(BudgetResyncState.budget_id == budget_id).first()
+                if resync_state is not None and resync_state.fingerprint == __get_budget_resync_fingerprint(pilot_budget):
+                    return BUDGET_RESYNC_RESULT_SKIPPED
+
+                budget_service.resync_pilot_budget(budget_id)
+
+                # 同步後詳情清單可能增減, 指紋以同步後狀態計算
+                pilot_budget = Budget.get_model_by_id(budget_id)
+                if resync_state is None:
+                    resync_state = BudgetResyncState(budget_id=budget_id)
+                    db.session.add(resync_state)
+                resync_state.fingerprint = __get_budget_resync_fingerprint(pilot_budget)
+                resync_state.last_sync_time = datetime.now()
+                db.session.commit()
+                return BUDGET_RESYNC_RESULT_SYNCED
+        except Exception:
+            db.session.rollback()
+            app.logger.exception(f'budget {budget_id} resync failed')
+            return BUDGET_RESYNC_RESULT_FAILED
+        finally:
+            db.session.remove()
+
+
+# 指紋: 來源EQ任務內容版本 + 預算詳情partnumber之單價幣別 + 相關幣別匯率
+def __get_budget_resync_fingerprint(pilot_budget):
+    content_version = resource_version_service.get_main_task_version(pilot_budget.source_main_eq_task_id)
+    price_row_list = db.session.query(Partnumber.id, Partnumber.price, Partnumber.currency) \
+        .join(BudgetContent, BudgetContent.partnumber_id == Partnumber.id) \
+        .filter(BudgetContent.budget_id == pilot_budget.id) \
+        .order_by(Partnumber.id) \
+        .all()
+    exchange_rate_dict = exchange_rate_service.new_exchange_rate_snapshot().get_exchange_rate_dict(
+        {_currency for (_id, _price, _currency) in price_row_list})
+    raw = repr((content_version,
+                [tuple(_row) for _row in price_row_list],
+                sorted(exchange_rate_dict.items())))
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+
+budget_resync_cli = AppGroup('budget-resync', help='初版預算背景同步')
+
+
+@budget_resync_cli.command('run')
+@click.option('--max-workers', type=int, default=BUDGET_RESYNC_MAX_WORKERS, help='同時同步之預算數')
+def run_budget_resync_command(max_workers):
+    resync_run = run_budget_resync(max_workers)
+    if resync_run is None:
+        click.echo('budget resync is running in another process')
+        return
+    click.echo(f'budget resync finished in {resync_run.duration_ms} ms: '
+               f'{resync_run.budget_count} budget, {resync_run.synced_count} synced, '
+               f'{resync_run.skipped_count} skipped, {resync_run.busy_count} busy, {resync_run.failed_count} failed')
@@ -1,15 +1,79 @@
+import base64
 import collections
+import json
+import os
+from datetime import datetime
+from decimal import Decimal
+
+from sqlalchemy import select, literal, union_all, func, and_, or_, event
+from sqlalchemy.orm import aliased, contains_eager, joinedload, selectinload
 
 from app import db
+from app.lib import excel_stream
+from app.model.base_bulk_model import get_audit_update_params
 from app.model.budget_model import Budget
-from app.model.budget_content_model import BudgetContent
+from app.model.budget_content_model import BudgetContent, get_budget_category_dict, get_user_code_dict, \
+    get_station_small_line_name_dict_by_phase_id, to_decimal
 from app.model.budget_demand_model import BudgetDemand
+from app.model.budget_guard_model import BudgetGuardContext
 from app.model.main_task_model import MainTask
 from app.model.partnumber_model import Partnumber
-from app.service import public_menu_service
-from app.service.main_task_service import get_eq_task_partnumber_demand_list_by_main_task_id
+from app.model.phase_model import Phase
+from app.service import eq_task_demand_rollup_service, exchange_rate_service, export_job_service, \
+    resource_version_service
+from app.util.advisory_lock import mysql_advisory_lock
 from app.util.api_exceptions import UnprocessableContentError, NotFoundError, ForbiddenError
 from app.util.enums import enum_budget_type, enum_task_type
+from app.util.version_cache import VersionCache
+
+BUDGET_TOTAL_COUNT_TTL_SECONDS = 60
+BUDGET_SYNC_LOCK_NAME_FORMAT = "wms_budget_sync_{}"
+
+# 需購買之partnumber, 只保留純量欄位, 不持有ORM物件
+FreshPartnumberDemand = collections.namedtuple("FreshPartnumberDemand", [
+    "partnumber_id", "total_demand_qty", "on_hand_qty", "total_purchase_qty", "unit_price", "unit_price_currency"])
+
+EXPORT_TYPE_BUDGET = "BUDGET"
+BUDGET_FILE_HEADER_LIST = [
+    "Part No.",
+    "Item Name(EN)",
+    "Item Name(CN)",
+    "Vendor",
+    "Spec",
+    "Category",
+    "Station",
+    "Line",
+    "Payment Method",
+    "Addition",
+    "Lead Time(Weeks) Low",
+    "Lead Time(Weeks) High",
+    "Buyer",
+    "User DRI",
+    "User Dept.",
+    "User Dept. Manager",
+    "User Code",
+    "Apple Counterpart",
+    "Reimburse Customer Check",
+    "Emergency Purchase Submit",
+    "Purchase Reason",
+    "Total Demand Q'ty",
+    "On-hand Q'ty",
+    "Total Purchase Q'ty",
+    "Unit Price",
+    "Currency",
+    "Exchange Rate To USD",
+    "USD Unit Price",
+    "USD Total",
+    "USD Additional",
+]
+BUDGET_FILE_SUMMARY_HEADER_LIST = ["Budget", "Type", "Group", "Name", "Demand Q'ty", "Purchase Q'ty", "USD Total",
+                                   "USD Additional"]
+
+__budget_total_count_cache = VersionCache(ttl_seconds=BUDGET_TOTAL_COUNT_TTL_SECONDS)
+
+PILOT_BUDGET_CONTENT_IGNORE_UPDATE = ["partnumber_id", "budget_id", "total_purchase_qty", "unit_price",
+                                      "unit_price_currency", "exchange_rate_to_usd"]
+PILOT_BUDGET_DEMAND_IGNORE_UPDATE = ["budget_content_id", "function"]
 
 
 # 1.初版預算只過度EQ匯總後Total Demand Q'ty > On Hand Q'ty 之partnumber
@@ -23,11 +87,17 @@ def add_pilot_budget(params):
 
     __insert_or_update_all_budget_content_by_pilot_budget_id(new_budget.id)
 
+    resource_version_service.bump_budget_list_version()
+    resource_version_service.bump_budget_version([new_budget.id])
     db.session.commit()
     return new_budget
 
 
-def __get_fresh_partnumber_demand_list_by_eq_main_task_id(eq_main_task_id):
+# 以欄位陣列(partnumber_id, function, demand_qty)計算最新需求:
+# 1.取得快取之EQ需求匯總欄位陣列, 依partnumber_id分組加總Total Demand Q'ty
+# 2.庫存以Partnumber.get_non_defective_qty_by_product_name逐一不重複partnumber取得, 以total_demand_qty - on_hand_qty > 0篩選需購買之partnumber
+# 3.回傳 {"partnumber_dict": {pn_id: FreshPartnumberDemand}, "function_demand_dict": {(pn_id, function): demand_qty}}
+def __get_fresh_partnumber_demand_by_eq_main_task_id(eq_main_task_id):
     eq_main_task = MainTask.get_model_by_id(eq_main_task_id)
 
     if eq_main_task is None:
@@ -36,37 +106,67 @@ def __get_fresh_partnumber_demand_list_by_eq_main_task_id(eq_main_task_id):
     if eq_main_task.task_type is not enum_task_type.EQ_LIST:
         raise UnprocessableContentError(msg=f'source must be eq task type')
 
-    migrate_partnumber_demand_list = []
+    demand_rollup = eq_task_demand_rollup_service.get_eq_task_demand_rollup_by_main_task_id(eq_main_task.id)
+
+    total_demand_qty_dict = collections.Counter()
+    function_demand_dict = collections.Counter()
+    for _pn_id, _function, _demand_qty in zip(demand_rollup["partnumber_id_column"],
+                                              demand_rollup["function_column"],
+                                              demand_rollup["demand_qty_column"]):
+        total_demand_qty_dict[_pn_id] += _demand_qty
+        function_demand_dict[(_pn_id, _function)] += _demand_qty
+
+    partnumber_list = Partnumber.query.filter(Partnumber.id.in_(list(total_demand_qty_dict))).all() \
+        if len(total_demand_qty_dict) > 0 else []
+    non_defective_qty_dict = {_pn.id: _pn.get_non_defective_qty_by_product_name(eq_main_task._phase._product.fx_code)
+                              for _pn in partnumber_list}
 
-    partnumber_demand_list = get_eq_task_partnumber_demand_list_by_main_task_id(eq_main_task.id)
-    for pn_demand in partnumber_demand_list:
-        partnumber_non_defective_qty = pn_demand.get("partnumber").get_non_defective_qty_by_product_name(
-            eq_main_task._phase._product.fx_code)
-        partnumber_total_demand_qty = sum(
-            [_function_demand['demand_qty'] for _function_demand in pn_demand.get("function_demand_list")])
-        total_purchase_qty = partnumber_total_demand_qty - partnumber_non_defective_qty
+    partnumber_dict = {}
+    for _pn in partnumber_list:
+        total_purchase_qty = total_demand_qty_dict[_pn.id] - non_defective_qty_dict[_pn.id]
         if total_purchase_qty > 0:
-            migrate_partnumber_demand_list.append(
-                dict(pn_demand, total_purchase_qty=total_purchase_qty, on_hand_qty=partnumber_non_defective_qty)
-            )
+            partnumber_dict[_pn.id] = FreshPartnumberDemand(partnumber_id=_pn.id,
+                                                            total_demand_qty=total_demand_qty_dict[_pn.id],
+                                                            on_hand_qty=non_defective_qty_dict[_pn.id],
+                                                            total_purchase_qty=total_purchase_qty,
+                                                            unit_price=to_decimal(_pn.price),
+                                                            unit_price_currency=_pn.currency)
 
-    return migrate_partnumber_demand_list
+    return {
+        "partnumber_dict": partnumber_dict,
+        "function_demand_dict": {_key: _demand_qty for _key, _demand_qty in function_demand_dict.items()
+                                 if _key[0] in partnumber_dict},
+    }
 
 
 def add_extra_or_additional_budget(params):
     new_budget = Budget.add_model_by_params(params)
+    resource_version_service.bump_budget_list_version()
     db.session.commit()
     return new_budget
 
 
 def update_budget(params):
     _budget = Budget.get_model_by_id(params.get("id")).update_model_by_params(params)
+    resource_version_service.bump_budget_list_version()
     db.session.commit()
     return _budget
 
 
+# 以單條UPDATE鎖定/解鎖階段下全部預算, 不經ORM事件, 修改者稽核欄位顯式帶入
+def update_budget_is_lock_by_phase_id(phase_id, is_lock):
+    rowcount = Budget.query.filter(Budget.phase_id == phase_id) \
+        .update(dict(get_audit_update_params(Budget.__table__), is_lock=is_lock), synchronize_session=False)
+    BudgetGuardContext.of_session(db.session).forget_all_budget()
+    resource_version_service.bump_budget_list_version()
+    db.session.commit()
+    return rowcount
+
+
 def delete_budget(budget_id):
     Budget.delete_model_by_id(budget_id)
+    resource_version_service.bump_budget_list_version()
+    resource_version_service.bump_budget_version([budget_id])
     db.session.commit()
 
 
@@ -80,6 +180,73 @@ def get_budget_page_by_params(params={},
                                                     orders=orders)
 
 
+# 以(create_time, id)游標分頁, 深頁與首頁成本相同; 總數可選且快取
+def get_budget_cursor_page_by_params(params={}, cursor=None, per_page=15, with_total=False):
+    query = __get_budget_query_by_params(params).options(
+        joinedload(Budget._phase).joinedload(Phase._product),
+        selectinload(Budget._extra_budget_list).joinedload(Budget._phase).joinedload(Phase._product),
+        selectinload(Budget._extra_budget_list).selectinload(Budget._extra_budget_list))
+
+    if cursor:
+        cursor_create_time, cursor_id = __decode_budget_cursor(cursor)
+        query = query.filter(or_(Budget.create_time < cursor_create_time,
+                                 and_(Budget.create_time == cursor_create_time, Budget.id < cursor_id)))
+
+    budget_list = query.order_by(Budget.create_time.desc(), Budget.id.desc()).limit(per_page + 1).all()
+    has_next = len(budget_list) > per_page
+    budget_list = budget_list[:per_page]
+
+    return {
+        "budget_list": budget_list,
+        "has_next": has_next,
+        "next_cursor": __encode_budget_cursor(budget_list[-1]) if has_next else None,
+        "total": get_budget_total_count_by_params(params) if with_total else None,
+    }
+
+
+def get_budget_total_count_by_params(params={}):
+    budget_type_list = __get_budget_type_list(params.get("budget_type"))
+    cache_key = (params.get("phase_id"), tuple(sorted(_budget_type.name for _budget_type in budget_type_list)))
+    return __budget_total_count_cache.get_or_load(
+        cache_key,
+        lambda: __get_budget_query_by_params(params).order_by(None).count())
+
+
+def invalidate_budget_total_count():
+    __budget_total_count_cache.invalidate()
+
+
+def __get_budget_query_by_params(params):
+    query = Budget.query
+    if params.get("phase_id") is not None:
+        query = query.filter(Budget.phase_id == params.get("phase_id"))
+    budget_type_list = __get_budget_type_list(params.get("budget_type"))
+    if budget_type_list:
+        query = query.filter(Budget.budget_type.in_(budget_type_list))
+    return query
+
+
+def __get_budget_type_list(budget_type):
+    if budget_type is None:
+        return []
+    if not isinstance(budget_type, (list, tuple)):
+        budget_type = [budget_type]
+    return [enum_budget_type(_budget_type) for _budget_type in budget_type]
+
+
+def __encode_budget_cursor(budget):
+    raw = json.dumps([budget.create_time.isoformat(), budget.id])
+    return base64.urlsafe_b64encode(raw.encode("utf-8")).decode("ascii")
+
+
+def __decode_budget_cursor(cursor):
+    try:
+        create_time, budget_id = json.loads(base64.urlsafe_b64decode(cursor.encode("ascii")).decode("utf-8"))
+        return datetime.fromisoformat(create_time), int(budget_id)
+    except (ValueError, TypeError):
+        raise UnprocessableContentError(msg=f'invalid budget cursor')
+
+
 def get_budget_menu_by_params(params={}, orders=collections.OrderedDict({"create_time": "desc"})):
     budget_list = Budget.get_model_list_by_params(params, orders=orders)
     return [{"id": _budget.id, "name": _budget.name} for _budget in budget_list]
@@ -91,104 +258,707 @@ def get_budget_menu_by_params(params={}, orders=collections.OrderedDict({"create
 # 4.刷新demand qty & pn清單(使用預算產品信息與良品種類去算On Hand Q'ty, 篩選Total Demand Q'ty > On Hand Q'ty 之partnumber) & on_hand_qty
 # 5.只有在非鎖定狀態且編輯模式才有此功能
 def synchronize_pilot_budget_demand_with_stock(pilot_budget_id):
+    with mysql_advisory_lock(get_budget_sync_lock_name(pilot_budget_id)) as acquired:
+        if not acquired:
+            raise UnprocessableContentError(msg=f'budget is synchronizing, please retry later')
+        pilot_budget = Budget.get_model_by_id(pilot_budget_id)
+        budget_demand_diff = __synchronize_pilot_budget_demand(pilot_budget,
+                                                               exchange_rate_service.new_exchange_rate_snapshot())
+        resource_version_service.bump_budget_version([pilot_budget.id])
+        db.session.commit()
+    return __summarize_pilot_budget_demand_diff(budget_demand_diff)
+
+
+# 背景排程同步: 以系統身份同步需求與單價匯率, 呼叫端須已持有get_budget_sync_lock_name之具名鎖
+def resync_pilot_budget(pilot_budget_id):
+    BudgetGuardContext.of_session(db.session).run_as_system()
+    pilot_budget = Budget.get_model_by_id(pilot_budget_id)
+    exchange_rate_snapshot = exchange_rate_service.new_exchange_rate_snapshot()
+    budget_demand_diff = __synchronize_pilot_budget_demand(pilot_budget, exchange_rate_snapshot)
+    __bulk_synchronize_budget_unit_price_and_currency_and_exchange_rate([pilot_budget], exchange_rate_snapshot)
+    resource_version_service.bump_budget_version([pilot_budget.id])
+    db.session.commit()
+    return __summarize_pilot_budget_demand_diff(budget_demand_diff)
+
+
+# 同一預算之同步(手動與背景排程)以具名鎖互斥
+def get_budget_sync_lock_name(budget_id):
+    return BUDGET_SYNC_LOCK_NAME_FORMAT.format(budget_id)
+
+
+# 預覽同步需求與數量: 與實際同步共用同一份比對, 只讀不寫入
+def preview_synchronize_pilot_budget_demand_with_stock(pilot_budget_id):
     pilot_budget = Budget.get_model_by_id(pilot_budget_id)
+    budget_demand_diff = __get_pilot_budget_demand_diff(pilot_budget)
+    # 只有查詢, 以rollback結束讀取交易
+    db.session.rollback()
+    return __build_pilot_budget_demand_diff_preview(budget_demand_diff)
 
+
+def __get_pilot_budget_demand_diff(pilot_budget):
     if pilot_budget.budget_type is not enum_budget_type.PILOT:
         raise UnprocessableContentError(msg=f'source must be pilot budget')
     pilot_budget.validate_source_main_eq_sub_tasks_all_approved()
 
-    fresh_partnumber_demand_list = __get_fresh_partnumber_demand_list_by_eq_main_task_id(
-        pilot_budget.source_main_eq_task_id)
-    fresh_partnumber_id_list = [(i.get("partnumber")).id for i in fresh_partnumber_demand_list]
-
-    delete_pn_id_list = []
-    for old_budget_content in pilot_budget._budget_content_list:
-        if old_budget_content.partnumber_id not in fresh_partnumber_id_list:
-            delete_pn_id_list.append(old_budget_content.partnumber_id)
-        else:
-            fresh_function_demand_list = next(
-                filter(lambda x: x.get("partnumber").id == old_budget_content.partnumber_id,
-                       fresh_partnumber_demand_list)).get("function_demand_list")
-            fresh_function_list = [(i.get("function")) for i in fresh_function_demand_list]
-            delete_function_list = []
-            for old_budget_demand in old_budget_content._budget_demand_list:
-                if old_budget_demand.function not in fresh_function_list:
-                    delete_function_list.append(old_budget_demand.function)
-            for delete_function in delete_function_list:
-                BudgetDemand.delete_models_by_params(
-                    {"function": delete_function, "budget_content_id": old_budget_content.id})
-            db.session.flush()
-    for delete_pn_id in delete_pn_id_list:
-        BudgetContent.delete_models_by_params({"partnumber_id": delete_pn_id, "budget_id": pilot_budget.id})
-    db.session.flush()
-
-    __insert_or_update_all_budget_content_by_pilot_budget_id(pilot_budget.id)
-
-    db.session.commit()
-    return pilot_budget
+    fresh_partnumber_demand = __get_fresh_partnumber_demand_by_eq_main_task_id(pilot_budget.source_main_eq_task_id)
+    return __diff_pilot_budget_demand(pilot_budget, fresh_partnumber_demand)
+
+
+def __synchronize_pilot_budget_demand(pilot_budget, exchange_rate_snapshot):
+    budget_demand_diff = __get_pilot_budget_demand_diff(pilot_budget)
+    __validate_pilot_budget_demand_diff_modifiable(pilot_budget, budget_demand_diff)
+    __apply_pilot_budget_demand_diff(pilot_budget, budget_demand_diff, exchange_rate_snapshot)
+    return budget_demand_diff
+
+
+# 比對預算現存詳情與最新需求:
+# 1.最新需求依partnumber_id與function建立索引, 現存詳情與需求一次查詢取出
+# 2.單次遍歷得出新增/修改/刪除之budget content與budget demand
+def __diff_pilot_budget_demand(pilot_budget, fresh_partnumber_demand):
+    fresh_partnumber_demand_dict = fresh_partnumber_demand["partnumber_dict"]
+    fresh_function_demand_dict = fresh_partnumber_demand["function_demand_dict"]
+
+    old_budget_content_dict = {}
+    old_budget_demand_dict = {}
+    old_row_list = db.session.query(BudgetContent.id,
+                                    BudgetContent.partnumber_id,
+                                    BudgetContent.on_hand_qty,
+                                    BudgetContent.total_purchase_qty,
+                                    BudgetDemand.id,
+                                    BudgetDemand.function,
+                                    BudgetDemand.demand_qty) \
+        .outerjoin(BudgetDemand, BudgetDemand.budget_content_id == BudgetContent.id) \
+        .filter(BudgetContent.budget_id == pilot_budget.id) \
+        .all()
+    for budget_content_id, partnumber_id, on_hand_qty, total_purchase_qty, budget_demand_id, function, demand_qty \
+            in old_row_list:
+        old_budget_content = old_budget_content_dict.setdefault(partnumber_id, {
+            "budget_content_id": budget_content_id,
+            "on_hand_qty": on_hand_qty,
+            "total_purchase_qty": total_purchase_qty,
+            "function_list": []
+        })
+        if budget_demand_id is not None:
+            old_budget_content["function_list"].append(function)
+            old_budget_demand_dict[(partnumber_id, function)] = {
+                "budget_demand_id": budget_demand_id,
+                "budget_content_id": budget_content_id,
+                "demand_qty": demand_qty
+            }
+
+    diff = {
+        "fresh_partnumber_demand_dict": fresh_partnumber_demand_dict,
+        "old_budget_content_dict": old_budget_content_dict,
+        "add_budget_content_list": [],
+        "change_budget_content_list": [],
+        "remove_budget_content_list": [],
+        "add_budget_demand_list": [],
+        "change_budget_demand_list": [],
+        "remove_budget_demand_list": [],
+    }
+
+    for _pn_id, _pn_demand in fresh_partnumber_demand_dict.items():
+        old_budget_content = old_budget_content_dict.get(_pn_id)
+        if old_budget_content is None:
+            diff["add_budget_content_list"].append({
+                "partnumber_id": _pn_id,
+                "on_hand_qty": _pn_demand.on_hand_qty,
+                "total_purchase_qty": _pn_demand.total_purchase_qty
+            })
+        elif old_budget_content["on_hand_qty"] != _pn_demand.on_hand_qty:
+            diff["change_budget_content_list"].append({
+                "partnumber_id": _pn_id,
+                "budget_content_id": old_budget_content["budget_content_id"],
+                "old_on_hand_qty": old_budget_content["on_hand_qty"],
+                "on_hand_qty": _pn_demand.on_hand_qty,
+                "total_purchase_qty": old_budget_content["total_purchase_qty"]
+            })
+    for _pn_id, old_budget_content in old_budget_content_dict.items():
+        if _pn_id not in fresh_partnumber_demand_dict:
+            diff["remove_budget_content_list"].append({
+                "partnumber_id": _pn_id,
+                "budget_content_id": old_budget_content["budget_content_id"],
+                "on_hand_qty": old_budget_content["on_hand_qty"],
+                "total_purchase_qty": old_budget_content["total_purchase_qty"]
+            })
+
+    for (_pn_id, _function), demand_qty in fresh_function_demand_dict.items():
+        old_budget_demand = old_budget_demand_dict.get((_pn_id, _function))
+        if old_budget_demand is None:
+            diff["add_budget_demand_list"].append({
+                "partnumber_id": _pn_id,
+                "function": _function,
+                "demand_qty": demand_qty
+            })
+        elif old_budget_demand["demand_qty"] != demand_qty:
+            diff["change_budget_demand_list"].append({
+                "partnumber_id": _pn_id,
+                "function": _function,
+                "budget_demand_id": old_budget_demand["budget_demand_id"],
+                "budget_content_id": old_budget_demand["budget_content_id"],
+                "old_demand_qty": old_budget_demand["demand_qty"],
+                "demand_qty": demand_qty
+            })
+    for (_pn_id, _function), old_budget_demand in old_budget_demand_dict.items():
+        if (_pn_id, _function) not in fresh_function_demand_dict:
+            diff["remove_budget_demand_list"].append({
+                "partnumber_id": _pn_id,
+                "function": _function,
+                "budget_demand_id": old_budget_demand["budget_demand_id"],
+                "old_demand_qty": old_budget_demand["demand_qty"]
+            })
+
+    return diff
+
+
+# 批量寫入不經過ORM事件, 鎖定與跨function校驗經由同一unit of work之BudgetGuardContext一次完成
+def __validate_pilot_budget_demand_diff_modifiable(pilot_budget, diff):
+    guard_context = BudgetGuardContext.of_session(db.session)
+    guard_context.validate_budget_content_unlock(pilot_budget.id)
+
+    old_budget_content_dict = diff["old_budget_content_dict"]
+    for _budget_content in diff["change_budget_content_list"] + diff["remove_budget_content_list"]:
+        guard_context.validate_budget_content_function(
+            old_budget_content_dict[_budget_content["partnumber_id"]]["function_list"])
+    for _budget_demand in diff["change_budget_demand_list"] + diff["remove_budget_demand_list"]:
+        guard_context.validate_budget_demand_function(_budget_demand["function"])
+
+
+# 批量修改整個預算之詳情: 非LL須對每筆詳情都有對應function之需求
+def __validate_budget_content_bulk_modifiable(target_budget):
+    guard_context = BudgetGuardContext.of_session(db.session)
+    guard_context.validate_budget_content_unlock(target_budget.id)
+    if guard_context.is_ll():
+        return
+
+    forbidden_budget_content_query = BudgetContent.query.filter(
+        BudgetContent.budget_id == target_budget.id,
+        ~BudgetContent._budget_demand_list.any(BudgetDemand.function.in_(guard_context.get_user_function_list())))
+    if db.session.query(forbidden_budget_content_query.exists()).scalar():
+        raise ForbiddenError(msg=f'budget content can not be modified while function of user not in demand list')
+
+
+# 依比對結果以批量DELETE ... IN / INSERT ... ON DUPLICATE KEY UPDATE寫入, 與呼叫端共用同一交易
+def __apply_pilot_budget_demand_diff(pilot_budget, diff, exchange_rate_snapshot):
+    fresh_partnumber_demand_dict = diff["fresh_partnumber_demand_dict"]
+
+    BudgetDemand.bulk_delete_by_ids([i["budget_demand_id"] for i in diff["remove_budget_demand_list"]])
+    BudgetContent.bulk_delete_by_ids([i["budget_content_id"] for i in diff["remove_budget_content_list"]])
+
+    budget_content_id_dict = {(pn_id, pilot_budget.id): i["budget_content_id"]
+                              for pn_id, i in diff["old_budget_content_dict"].items()}
+    budget_content_id_dict.update(BudgetContent.bulk_insert_or_update(
+        [__build_pilot_budget_content_params(pilot_budget, fresh_partnumber_demand_dict[i["partnumber_id"]],
+                                             exchange_rate_snapshot)
+         for i in diff["add_budget_content_list"] + diff["change_budget_content_list"]],
+        ignore_update=PILOT_BUDGET_CONTENT_IGNORE_UPDATE))
+
+    BudgetDemand.bulk_insert_or_update([{
+        "function": _budget_demand["function"],
+        "demand_qty": _budget_demand["demand_qty"],
+        "budget_content_id": budget_content_id_dict[(_budget_demand["partnumber_id"], pilot_budget.id)],
+    } for _budget_demand in diff["add_budget_demand_list"] + diff["change_budget_demand_list"]],
+        ignore_update=PILOT_BUDGET_DEMAND_IGNORE_UPDATE)
+
+    db.session.expire(pilot_budget)
+
+
+def __summarize_pilot_budget_demand_diff(diff):
+    return {
+        "budget_content": {
+            "added": len(diff["add_budget_content_list"]),
+            "changed": len(diff["change_budget_content_list"]),
+            "removed": len(diff["remove_budget_content_list"]),
+        },
+        "budget_demand": {
+            "added": len(diff["add_budget_demand_list"]),
+            "changed": len(diff["change_budget_demand_list"]),
+            "removed": len(diff["remove_budget_demand_list"]),
+        },
+    }
+
+
+# 預覽明細: budget content以on_hand_qty, budget demand以demand_qty計算異動量
+# 詳情之qty為Total Purchase Q'ty; 同步不修改現存詳情之購買數量, 修改之詳情只有On Hand Q'ty變動
+def __build_pilot_budget_demand_diff_preview(diff):
+    return {
+        "summary": __summarize_pilot_budget_demand_diff(diff),
+        "budget_content": {
+            "added": [{
+                "partnumber_id": i["partnumber_id"],
+                "old_qty": None,
+                "qty": i["total_purchase_qty"],
+                "delta_qty": i["total_purchase_qty"],
+                "old_on_hand_qty": None,
+                "on_hand_qty": i["on_hand_qty"],
+            } for i in diff["add_budget_content_list"]],
+            "changed": [{
+                "partnumber_id": i["partnumber_id"],
+                "old_qty": i["total_purchase_qty"],
+                "qty": i["total_purchase_qty"],
+                "delta_qty": 0,
+                "old_on_hand_qty": i["old_on_hand_qty"],
+                "on_hand_qty": i["on_hand_qty"],
+            } for i in diff["change_budget_content_list"]],
+            "removed": [{
+                "partnumber_id": i["partnumber_id"],
+                "old_qty": i["total_purchase_qty"],
+                "qty": None,
+                "delta_qty": -i["total_purchase_qty"],
+                "old_on_hand_qty": i["on_hand_qty"],
+                "on_hand_qty": None,
+            } for i in diff["remove_budget_content_list"]],
+        },
+        "budget_demand": {
+            "added": [{
+                "partnumber_id": i["partnumber_id"],
+                "function": i["function"],
+                "old_qty": None,
+                "qty": i["demand_qty"],
+                "delta_qty": i["demand_qty"],
+            } for i in diff["add_budget_demand_list"]],
+            "changed": [{
+                "partnumber_id": i["partnumber_id"],
+                "function": i["function"],
+                "old_qty": i["old_demand_qty"],
+                "qty": i["demand_qty"],
+                "delta_qty": i["demand_qty"] - i["old_demand_qty"],
+            } for i in diff["change_budget_demand_list"]],
+            "removed": [{
+                "partnumber_id": i["partnumber_id"],
+                "function": i["function"],
+                "old_qty": i["old_demand_qty"],
+                "qty": None,
+                "delta_qty": -i["old_demand_qty"],
+            } for i in diff["remove_budget_demand_list"]],
+        },
+    }
 
 
 def __insert_or_update_all_budget_content_by_pilot_budget_id(pilot_budget_id):
     pilot_budget = Budget.get_model_by_id(pilot_budget_id)
+    BudgetGuardContext.of_session(db.session).validate_budget_content_unlock(pilot_budget.id)
+
+    fresh_partnumber_demand = __get_fresh_partnumber_demand_by_eq_main_task_id(pilot_budget.source_main_eq_task_id)
+    exchange_rate_snapshot = exchange_rate_service.new_exchange_rate_snapshot()
+
+    # 購買須滿足最小架站要求
+    # update_budget_content_ignore_properties = ["partnumber_id", "budget_id", "total_purchase_qty", "unit_price", "unit_price_currency",
+    #  "exchange_rate_to_usd"]
+    # existed_budget_content = BudgetContent.get_model_by_params({"partnumber_id": _pn.id, "budget_id": pilot_budget.id})
+    # if existed_budget_content is not None and fresh_partnumber_demand.get("total_purchase_qty") > existed_budget_content.total_purchase_qty:
+    #     update_budget_content_ignore_properties.remove("total_purchase_qty")
+
+    budget_content_id_dict = BudgetContent.bulk_insert_or_update(
+        [__build_pilot_budget_content_params(pilot_budget, _pn_demand, exchange_rate_snapshot)
+         for _pn_demand in fresh_partnumber_demand["partnumber_dict"].values()],
+        ignore_update=PILOT_BUDGET_CONTENT_IGNORE_UPDATE)
+
+    BudgetDemand.bulk_insert_or_update([{
+        "function": _function,
+        "demand_qty": _demand_qty,
+        "budget_content_id": budget_content_id_dict[(_pn_id, pilot_budget.id)],
+    } for (_pn_id, _function), _demand_qty in fresh_partnumber_demand["function_demand_dict"].items()],
+        ignore_update=PILOT_BUDGET_DEMAND_IGNORE_UPDATE)
+
+    db.session.expire(pilot_budget)
+    return pilot_budget
 
-    fresh_partnumber_demand_list = __get_fresh_partnumber_demand_list_by_eq_main_task_id(
-        pilot_budget.source_main_eq_task_id)
-
-    for fresh_partnumber_demand in fresh_partnumber_demand_list:
-        _pn = fresh_partnumber_demand.get("partnumber")
-
-        # 購買須滿足最小架站要求
-        # update_budget_content_ignore_properties = ["partnumber_id", "budget_id", "total_purchase_qty", "unit_price", "unit_price_currency",
-        #  "exchange_rate_to_usd"]
-        # existed_budget_content = BudgetContent.get_model_by_params({"partnumber_id": _pn.id, "budget_id": pilot_budget.id})
-        # if existed_budget_content is not None and fresh_partnumber_demand.get("total_purchase_qty") > existed_budget_content.total_purchase_qty:
-        #     update_budget_content_ignore_properties.remove("total_purchase_qty")
-
-        BudgetContent.insert_or_update({
-            "partnumber_id": _pn.id,
-            "budget_id": pilot_budget.id,
-            "total_purchase_qty": fresh_partnumber_demand.get("total_purchase_qty"),
-            "on_hand_qty": fresh_partnumber_demand.get("on_hand_qty"),
-            "unit_price": _pn.price,
-            "unit_price_currency": _pn.currency,
-            "exchange_rate_to_usd": public_menu_service.get_exchange_rate_to_usd(_pn.currency)
-        }, ignore_update=["partnumber_id", "budget_id", "total_purchase_qty", "unit_price", "unit_price_currency",
-         "exchange_rate_to_usd"])
-
-        _budget_content = BudgetContent.get_model_by_params(params={"partnumber_id": _pn.id, "budget_id": pilot_budget.id})
-
-        for _function_demand in fresh_partnumber_demand.get("function_demand_list"):
-            BudgetDemand.insert_or_update({
-                "function": _function_demand.get("function"),
-                "demand_qty": _function_demand.get("demand_qty"),
-                "budget_content_id": _budget_content.id,
-            }, ignore_update=["budget_content_id", "function"])
 
-    return pilot_budget
+def __build_pilot_budget_content_params(pilot_budget, fresh_partnumber_demand, exchange_rate_snapshot):
+    return {
+        "partnumber_id": fresh_partnumber_demand.partnumber_id,
+        "budget_id": pilot_budget.id,
+        "total_purchase_qty": fresh_partnumber_demand.total_purchase_qty,
+        "on_hand_qty": fresh_partnumber_demand.on_hand_qty,
+        "unit_price": fresh_partnumber_demand.unit_price,
+        "unit_price_currency": fresh_partnumber_demand.unit_price_currency,
+        "exchange_rate_to_usd": exchange_rate_snapshot.get_exchange_rate_to_usd(fresh_partnumber_demand.unit_price_currency)
+    }
 
 
 # 1.刷新unit price
 # 2.只有在非鎖定狀態且編輯模式才有此功能
 # 3.只有LL有權限操作此功能
 def synchronize_budget_unit_price_and_currency_and_exchange_rate_with_partnumber_info(budget_id):
-    target_budget = Budget.get_model_by_id(budget_id)
-    for _budget_content in target_budget._budget_content_list:
-        _budget_content.unit_price = _budget_content._partnumber.price
-        _budget_content.unit_price_currency = _budget_content._partnumber.currency
-        _budget_content.exchange_rate_to_usd = public_menu_service.get_exchange_rate_to_usd(_budget_content._partnumber.currency)
-    db.session.commit()
+    with mysql_advisory_lock(get_budget_sync_lock_name(budget_id)) as acquired:
+        if not acquired:
+            raise UnprocessableContentError(msg=f'budget is synchronizing, please retry later')
+        target_budget = Budget.get_model_by_id(budget_id)
+        __bulk_synchronize_budget_unit_price_and_currency_and_exchange_rate(
+            [target_budget], exchange_rate_service.new_exchange_rate_snapshot())
+        resource_version_service.bump_budget_version([target_budget.id])
+        db.session.commit()
     return target_budget
 
 
-def get_budget_file_by_type_and_id(budget_id, types=enum_budget_type.get_name_list()):
-    # TODO: implement file generate
+# 跨預算批量刷新unit price, 供夜間排程使用
+def synchronize_budget_unit_price_and_currency_and_exchange_rate_by_budget_id_list(budget_id_list):
+    target_budget_list = Budget.query.filter(Budget.id.in_(budget_id_list)).all()
+    if len(target_budget_list) != len(set(budget_id_list)):
+        raise NotFoundError(msg=f'budget not found')
+    rowcount = __bulk_synchronize_budget_unit_price_and_currency_and_exchange_rate(
+        target_budget_list, exchange_rate_service.new_exchange_rate_snapshot())
+    resource_version_service.bump_budget_version([_budget.id for _budget in target_budget_list])
+    db.session.commit()
+    return rowcount
+
+
+# 以單條UPDATE wms_budget_content JOIN wms_partnumber JOIN (匯率衍生表) 刷新, 鎖定與權限每個預算只校驗一次
+def __bulk_synchronize_budget_unit_price_and_currency_and_exchange_rate(target_budget_list, exchange_rate_snapshot):
+    for _budget in target_budget_list:
+        __validate_budget_content_bulk_modifiable(_budget)
+
+    budget_id_list = [_budget.id for _budget in target_budget_list]
+    currency_list = [_currency for (_currency,) in db.session.query(Partnumber.currency)
+        .join(BudgetContent, BudgetContent.partnumber_id == Partnumber.id)
+        .filter(BudgetContent.budget_id.in_(budget_id_list))
+        .distinct()
+        .all()]
+    if len(currency_list) == 0:
+        return 0
+
+    exchange_rate_dict = exchange_rate_snapshot.get_exchange_rate_dict(currency_list)
+    exchange_rate_select_list = [select([literal(_currency).label("currency"),
+                                         literal(_exchange_rate).label("exchange_rate_to_usd")])
+                                 for _currency, _exchange_rate in exchange_rate_dict.items()]
+    if len(exchange_rate_select_list) == 1:
+        exchange_rate_table = exchange_rate_select_list[0].alias("exchange_rate")
+    else:
+        exchange_rate_table = union_all(*exchange_rate_select_list).alias("exchange_rate")
+
+    rst = db.session.execute(
+        BudgetContent.__table__.update()
+            .where(BudgetContent.partnumber_id == Partnumber.id)
+            .where(Partnumber.currency == exchange_rate_table.c.currency)
+            .where(BudgetContent.budget_id.in_(budget_id_list))
+            .values(unit_price=Partnumber.price,
+                    unit_price_currency=Partnumber.currency,
+                    exchange_rate_to_usd=exchange_rate_table.c.exchange_rate_to_usd,
+                    **get_audit_update_params(BudgetContent.__table__)))
+    for _budget in target_budget_list:
+        db.session.expire(_budget)
+    return rst.rowcount
+
+
+def submit_budget_file_export_job_by_params(params):
+    return export_job_service.submit_export_job(EXPORT_TYPE_BUDGET, params)
 
-    return
+
+def get_budget_file_by_type_and_id(budget_id, types=enum_budget_type.get_name_list()):
+    file_path = excel_stream.make_temp_excel_file_path()
+    try:
+        file_name = write_budget_file_by_params({"budget_id": budget_id, "budget_type": types}, file_path)
+    except Exception:
+        os.remove(file_path)
+        raise
+    return excel_stream.make_streaming_excel_response(file_path, file_name)
+
+
+# 1.初版預算連同其追加預算一併匯出, 依types篩選預算類型, 每個預算一個工作表, 另附匯總表
+# 2.詳情與需求各以一條查詢取出純量欄位, USD金額由資料庫計算, 不逐筆求值ORM屬性
+# 3.以write_only workbook逐列寫入暫存檔, 回傳下載檔名; 有progress時回報已寫入列數
+def write_budget_file_by_params(params, file_path, progress=None):
+    target_budget = Budget.query.options(joinedload(Budget._phase).joinedload(Phase._product)) \
+        .filter(Budget.id == params.get("budget_id")).first()
+    if target_budget is None:
+        raise NotFoundError(msg=f'budget not found')
+
+    budget_type_list = __get_budget_type_list(params.get("budget_type") or enum_budget_type.get_value_list())
+    budget_list = [target_budget] + sorted(target_budget._extra_budget_list, key=lambda _budget: _budget.id)
+    budget_list = [_budget for _budget in budget_list if _budget.budget_type in budget_type_list]
+    budget_id_list = [_budget.id for _budget in budget_list]
+
+    budget_content_column_dict = __get_budget_file_column_dict(budget_id_list)
+    function_demand_dict = __get_budget_file_function_demand_dict(budget_id_list)
+
+    summary_row_list = list(__iter_budget_file_summary_row(
+        budget_list, get_budget_summary_by_params({"budget_id": budget_id_list}) if len(budget_id_list) > 0 else []))
+
+    on_row_written = None
+    if progress is not None:
+        progress.set_total_row_count(len(summary_row_list) + sum(
+            len(_column_dict["budget_content_id"]) for _column_dict in budget_content_column_dict.values()))
+        on_row_written = progress.add_written_row_count
+
+    workbook = excel_stream.create_write_only_workbook()
+    excel_stream.append_write_only_sheet(
+        workbook, "Summary", BUDGET_FILE_SUMMARY_HEADER_LIST, summary_row_list, on_row_written=on_row_written)
+    for _budget in budget_list:
+        function_list = sorted({_function for (_budget_content_id, _function) in function_demand_dict.get(_budget.id, {})})
+        excel_stream.append_write_only_sheet(
+            workbook, f"{_budget.budget_type.name} {_budget.name}",
+            BUDGET_FILE_HEADER_LIST + [f"{_function} Demand Q'ty" for _function in function_list],
+            __iter_budget_file_row(budget_content_column_dict.get(_budget.id, {}),
+                                   function_demand_dict.get(_budget.id, {}),
+                                   function_list,
+                                   get_station_small_line_name_dict_by_phase_id(_budget.phase_id)),
+            on_row_written=on_row_written)
+    workbook.save(file_path)
+
+    _phase = target_budget._phase
+    return f"{_phase._product.fx_code} {_phase.name} {target_budget.name} Budget.xlsx"
+
+
+# 詳情以一條查詢取出, 依budget_id分組為欄位陣列: {budget_id: {column_name: [value, ...]}}
+def __get_budget_file_column_dict(budget_id_list):
+    if len(budget_id_list) == 0:
+        return {}
+
+    _item_class = Partnumber._vendor_item.property.mapper.class_
+    _vendor_item = aliased(_item_class)
+    _spec_item = aliased(_item_class)
+    _station_item = aliased(_item_class)
+    _category_item = aliased(_item_class)
+    total_demand_qty_subquery = db.session.query(
+        BudgetDemand.budget_content_id.label("budget_content_id"),
+        func.sum(BudgetDemand.demand_qty).label("total_demand_qty")) \
+        .join(BudgetContent, BudgetContent.id == BudgetDemand.budget_content_id) \
+        .filter(BudgetContent.budget_id.in_(budget_id_list)) \
+        .group_by(BudgetDemand.budget_content_id) \
+        .subquery()
+    total_demand_qty = func.coalesce(total_demand_qty_subquery.c.total_demand_qty, 0)
+
+    column_list = [
+        ("budget_id", BudgetContent.budget_id),
+        ("budget_content_id", BudgetContent.id),
+        ("part_no", BudgetContent.part_no),
+        ("en_name", Partnumber.en_name),
+        ("zh_name", Partnumber.zh_name),
+        ("vendor", _vendor_item.item_name),
+        ("spec", _spec_item.item_name),
+        ("category_name", _category_item.item_name),
+        ("station_name", _station_item.item_name),
+        ("payment_method", Partnumber.payment_method),
+        ("addition", BudgetContent.addition),
+        ("lead_time_weeks_low", BudgetContent.lead_time_weeks_low),
+        ("lead_time_weeks_high", BudgetContent.lead_time_weeks_high),
+        ("buyer", BudgetContent.buyer),
+        ("user_dri", BudgetContent.user_dri),
+        ("user_dept", BudgetContent.user_dept),
+        ("user_dept_manager", BudgetContent.user_dept_manager),
+        ("apple_counterpart", BudgetContent.apple_counterpart),
+        ("reimburse_customer_check", BudgetContent.reimburse_customer_check),
+        ("emergency_purchase_submit", BudgetContent.emergency_purchase_submit),
+        ("purchase_reason", BudgetContent.purchase_reason),
+        ("total_demand_qty", total_demand_qty),
+        ("on_hand_qty", BudgetContent.on_hand_qty),
+        ("total_purchase_qty", BudgetContent.total_purchase_qty),
+        ("unit_price", BudgetContent.unit_price),
+        ("unit_price_currency", BudgetContent.unit_price_currency),
+        ("exchange_rate_to_usd", BudgetContent.exchange_rate_to_usd),
+        ("usd_unit_price", BudgetContent.usd_unit_price),
+        ("usd_total", BudgetContent.usd_unit_price * total_demand_qty),
+        ("usd_additional", BudgetContent.usd_additional),
+    ]
+    row_list = db.session.query(*[_column for (_column_name, _column) in column_list]) \
+        .select_from(BudgetContent) \
+        .join(Partnumber, Partnumber.id == BudgetContent.partnumber_id) \
+        .outerjoin(_vendor_item, Partnumber._vendor_item.of_type(_vendor_item)) \
+        .outerjoin(_spec_item, Partnumber._spec_item.of_type(_spec_item)) \
+        .outerjoin(_station_item, Partnumber._station_item.of_type(_station_item)) \
+        .outerjoin(_category_item, Partnumber._asset_category_item.of_type(_category_item)) \
+        .outerjoin(total_demand_qty_subquery, total_demand_qty_subquery.c.budget_content_id == BudgetContent.id) \
+        .filter(BudgetContent.budget_id.in_(budget_id_list)) \
+        .order_by(BudgetContent.budget_id, BudgetContent.id) \
+        .all()
+
+    column_name_list = [_column_name for (_column_name, _column) in column_list]
+    budget_content_column_dict = {}
+    for _row in row_list:
+        _column_dict = budget_content_column_dict.setdefault(
+            _row[0], {_column_name: [] for _column_name in column_name_list})
+        for _column_name, _value in zip(column_name_list, _row):
+            _column_dict[_column_name].append(_value)
+    return budget_content_column_dict
+
+
+# 需求以一條查詢取出: {budget_id: {(budget_content_id, function): demand_qty}}
+def __get_budget_file_function_demand_dict(budget_id_list):
+    if len(budget_id_list) == 0:
+        return {}
+
+    row_list = db.session.query(BudgetContent.budget_id,
+                                BudgetDemand.budget_content_id,
+                                BudgetDemand.function,
+                                BudgetDemand.demand_qty) \
+        .join(BudgetContent, BudgetContent.id == BudgetDemand.budget_content_id) \
+        .filter(BudgetContent.budget_id.in_(budget_id_list)) \
+        .all()
+    function_demand_dict = {}
+    for budget_id, budget_content_id, function, demand_qty in row_list:
+        function_demand_dict.setdefault(budget_id, {})[(budget_content_id, function)] = demand_qty
+    return function_demand_dict
+
+
+def __iter_budget_file_row(column_dict, function_demand_dict, function_list, station_small_line_name_dict):
+    if len(column_dict) == 0:
+        return
+
+    budget_category_dict = get_budget_category_dict()
+    user_code_dict = get_user_code_dict()
+    # 映射類欄位每個預算只轉換一次整欄
+    category_column = [budget_category_dict.get(_name) for _name in column_dict["category_name"]]
+    station_column = ["ALL" if _name == "通用" else _name for _name in column_dict["station_name"]]
+    small_line_column = ["ALL" if _station == "ALL" else station_small_line_name_dict.get(_station, "ALL")
+                         for _station in station_column]
+    user_code_column = [None if _user_dept is None else user_code_dict.get((_payment_method, _user_dept))
+                        for _payment_method, _user_dept in zip(column_dict["payment_method"], column_dict["user_dept"])]
+    function_demand_column_list = [[function_demand_dict.get((_budget_content_id, _function))
+                                    for _budget_content_id in column_dict["budget_content_id"]]
+                                   for _function in function_list]
+
+    for _row in zip(column_dict["part_no"],
+                    column_dict["en_name"],
+                    column_dict["zh_name"],
+                    column_dict["vendor"],
+                    column_dict["spec"],
+                    category_column,
+                    station_column,
+                    small_line_column,
+                    column_dict["payment_method"],
+                    column_dict["addition"],
+                    column_dict["lead_time_weeks_low"],
+                    column_dict["lead_time_weeks_high"],
+                    column_dict["buyer"],
+                    column_dict["user_dri"],
+                    column_dict["user_dept"],
+                    column_dict["user_dept_manager"],
+                    user_code_column,
+                    column_dict["apple_counterpart"],
+                    [_confirm.name if _confirm is not None else None for _confirm in column_dict["reimburse_customer_check"]],
+                    [_confirm.name if _confirm is not None else None for _confirm in column_dict["emergency_purchase_submit"]],
+                    column_dict["purchase_reason"],
+                    [int(_qty) for _qty in column_dict["total_demand_qty"]],
+                    column_dict["on_hand_qty"],
+                    column_dict["total_purchase_qty"],
+                    column_dict["unit_price"],
+                    column_dict["unit_price_currency"],
+                    column_dict["exchange_rate_to_usd"],
+                    column_dict["usd_unit_price"],
+                    column_dict["usd_total"],
+                    column_dict["usd_additional"],
+                    *function_demand_column_list):
+        yield list(_row)
+
+
+def __iter_budget_file_summary_row(budget_list, budget_summary_list):
+    budget_summary_dict = {_budget_summary["budget_id"]: _budget_summary for _budget_summary in budget_summary_list}
+    for _budget in budget_list:
+        _budget_summary = budget_summary_dict.get(_budget.id)
+        if _budget_summary is None:
+            continue
+        for _function_summary in _budget_summary["function_list"]:
+            yield [_budget.name, _budget.budget_type.name, "Function", _function_summary["function"],
+                   _function_summary["demand_qty"], None, _function_summary["usd_total"], None]
+        for _category_summary in _budget_summary["category_list"]:
+            yield [_budget.name, _budget.budget_type.name, "Category", _category_summary["category"],
+                   None, None, _category_summary["usd_total"], _category_summary["usd_additional"]]
+        yield [_budget.name, _budget.budget_type.name, "Total", None,
+               _budget_summary["total_demand_qty"], _budget_summary["total_purchase_qty"],
+               _budget_summary["usd_total"], _budget_summary["usd_additional"]]
+
+
+# 預算USD匯總: 需求(per function)與追加(per content)粒度不同, 各以一條GROUP BY於資料庫計算
+def get_budget_summary_by_params(params):
+    budget_filter_list = []
+    if params.get("budget_id") is not None and len(params.get("budget_id")) > 0:
+        budget_filter_list.append(BudgetContent.budget_id.in_(params.get("budget_id")))
+    if params.get("phase_id") is not None:
+        budget_filter_list.append(Budget.phase_id == params.get("phase_id"))
+    if len(budget_filter_list) == 0:
+        raise UnprocessableContentError(msg=f'budget id or phase id is required')
+
+    _category_item = Partnumber._asset_category_item.property.mapper.class_
+    demand_row_list = db.session.query(BudgetContent.budget_id,
+                                       _category_item.item_name,
+                                       BudgetDemand.function,
+                                       func.sum(BudgetDemand.demand_qty),
+                                       func.sum(BudgetContent.usd_unit_price * BudgetDemand.demand_qty)) \
+        .select_from(BudgetContent) \
+        .join(Budget, Budget.id == BudgetContent.budget_id) \
+        .join(BudgetDemand, BudgetDemand.budget_content_id == BudgetContent.id) \
+        .join(Partnumber, Partnumber.id == BudgetContent.partnumber_id) \
+        .join(Partnumber._asset_category_item) \
+        .filter(*budget_filter_list) \
+        .group_by(BudgetContent.budget_id, _category_item.item_name, BudgetDemand.function) \
+        .all()
+    additional_row_list = db.session.query(BudgetContent.budget_id,
+                                           _category_item.item_name,
+                                           func.sum(BudgetContent.total_purchase_qty),
+                                           func.sum(BudgetContent.usd_additional)) \
+        .select_from(BudgetContent) \
+        .join(Budget, Budget.id == BudgetContent.budget_id) \
+        .join(Partnumber, Partnumber.id == BudgetContent.partnumber_id) \
+        .join(Partnumber._asset_category_item) \
+        .filter(*budget_filter_list) \
+        .group_by(BudgetContent.budget_id, _category_item.item_name) \
+        .all()
+
+    budget_category_dict = get_budget_category_dict()
+    budget_summary_dict = {}
+
+    def _get_budget_summary(budget_id):
+        return budget_summary_dict.setdefault(budget_id, {
+            "budget_id": budget_id,
+            "total_demand_qty": 0,
+            "total_purchase_qty": 0,
+            "usd_total": Decimal(0),
+            "usd_additional": Decimal(0),
+            "function_dict": {},
+            "category_dict": {},
+        })
+
+    def _get_category_summary(budget_summary, category_name):
+        category = budget_category_dict.get(category_name)
+        return budget_summary["category_dict"].setdefault(category, {
+            "category": category,
+            "usd_total": Decimal(0),
+            "usd_additional": Decimal(0),
+        })
+
+    for budget_id, category_name, function, demand_qty, usd_total in demand_row_list:
+        budget_summary = _get_budget_summary(budget_id)
+        function_summary = budget_summary["function_dict"].setdefault(function, {
+            "function": function,
+            "demand_qty": 0,
+            "usd_total": Decimal(0),
+        })
+        function_summary["demand_qty"] += int(demand_qty)
+        function_summary["usd_total"] += __to_summary_decimal(usd_total)
+        _get_category_summary(budget_summary, category_name)["usd_total"] += __to_summary_decimal(usd_total)
+        budget_summary["total_demand_qty"] += int(demand_qty)
+        budget_summary["usd_total"] += __to_summary_decimal(usd_total)
+
+    for budget_id, category_name, total_purchase_qty, usd_additional in additional_row_list:
+        budget_summary = _get_budget_summary(budget_id)
+        _get_category_summary(budget_summary, category_name)["usd_additional"] += __to_summary_decimal(usd_additional)
+        budget_summary["total_purchase_qty"] += int(total_purchase_qty)
+        budget_summary["usd_additional"] += __to_summary_decimal(usd_additional)
+
+    for _budget_summary in budget_summary_dict.values():
+        _budget_summary["function_list"] = list(_budget_summary.pop("function_dict").values())
+        _budget_summary["category_list"] = list(_budget_summary.pop("category_dict").values())
+    return list(budget_summary_dict.values())
+
+
+# SUM(DECIMAL)回傳Decimal, 以Decimal累加避免轉float產生之誤差; 無對應列之SUM為NULL
+def __to_summary_decimal(value):
+    return to_decimal(value) if value is not None else Decimal(0)
 
 
 def get_budget_content_by_params(params):
-    budget_content_list_query = BudgetContent.query.join(Partnumber).filter(
-             BudgetContent.budget_id == params.get("budget_id"))
+    # 明確指定載入策略, 序列化時不再逐筆lazy load, 查詢次數與筆數無關
+    _partnumber_loader = contains_eager(BudgetContent._partnumber)
+    _phase_loader = joinedload(BudgetContent._budget).joinedload(Budget._phase)
+    budget_content_list_query = BudgetContent.query.join(Partnumber).options(
+        _partnumber_loader.joinedload(Partnumber._station_item),
+        _partnumber_loader.joinedload(Partnumber._asset_category_item),
+        _partnumber_loader.joinedload(Partnumber._vendor_item),
+        _partnumber_loader.joinedload(Partnumber._spec_item),
+        selectinload(BudgetContent._budget_demand_list),
+        _phase_loader.joinedload(Phase._product),
+    ).filter(BudgetContent.budget_id == params.get("budget_id"))
     if params.get("purchase_method") is not None and len(params.get("purchase_method")) > 0:
         budget_content_list_query = budget_content_list_query.filter(Partnumber.payment_method.in_(params.get("purchase_method")))
     rst = budget_content_list_query.all()
@@ -205,24 +975,29 @@ def add_budget_content(params):
     _pn = Partnumber.get_model_by_id(params.get("partnumber_id"))
     params.update({
         "on_hand_qty": _pn.get_non_defective_qty_by_product_name(target_budget._phase._product.fx_code),
-        "unit_price": _pn.price,
+        "unit_price": to_decimal(_pn.price),
         "unit_price_currency": _pn.currency,
-        "exchange_rate_to_usd": public_menu_service.get_exchange_rate_to_usd(_pn.currency),
+        "exchange_rate_to_usd": exchange_rate_service.new_exchange_rate_snapshot().get_exchange_rate_to_usd(
+            _pn.currency),
     })
 
     new_budget_content = BudgetContent.add_model_by_params(params)
+    resource_version_service.bump_budget_version([target_budget.id])
     db.session.commit()
     return new_budget_content
 
 
 def update_budget_content(params):
     _budget_content = BudgetContent.get_model_by_id(params.get("id")).update_model_by_params(params)
+    resource_version_service.bump_budget_version([_budget_content.budget_id])
     db.session.commit()
     return _budget_content
 
 
 def delete_budget_content(budget_content_id):
+    budget_id = BudgetContent.get_model_by_id(budget_content_id).budget_id
     BudgetContent.delete_model_by_id(budget_content_id)
+    resource_version_service.bump_budget_version([budget_id])
     db.session.commit()
 
 
@@ -235,12 +1010,15 @@ def delete_budget_demand(budget_demand_id):
     if len(target_budget_content._budget_demand_list) <= 0:
         BudgetContent.delete_model_by_id(target_budget_content.id)
 
+    resource_version_service.bump_budget_version([target_budget_content.budget_id])
     db.session.commit()
 
 
 def insert_or_update_budget_demand(params):
     __validate_budget_demand_manually_modified_forbidden(params.get("budget_content_id"))
     _budget_demand = BudgetDemand.insert_or_update(params, ignore_update=["budget_content_id", "function"])
+    resource_version_service.bump_budget_version(
+        [BudgetContent.get_model_by_id(params.get("budget_content_id")).budget_id])
     db.session.commit()
     return _budget_demand
 
@@ -251,6 +1029,10 @@ def __validate_budget_demand_manually_modified_forbidden(budget_content_id):
         raise ForbiddenError(msg=f'pilot budget can not manually modify budget content')
 
 
+export_job_service.register_export_writer(EXPORT_TYPE_BUDGET, write_budget_file_by_params)
 
 
-
+@event.listens_for(Budget, 'after_insert')
+@event.listens_for(Budget, 'after_delete')
+def budget_after_insert_or_delete_handler(mapper, connection, target: Budget):
+    invalidate_budget_total_count()
@@ -0,0 +1,36 @@
+import functools
+import hashlib
+
+from flask import request, Response
+from werkzeug.http import quote_etag
+
+
+def etag_conditional_get(version_loader):
+    """
+        條件式GET: 以version_loader(request.args)取得版本號產生ETag,
+        If-None-Match命中時直接回傳304, 不執行被裝飾之查詢;
+        需置於marshal_with之上
+    """
+
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            version = version_loader(request.args)
+            if version is None:
+                return func(*args, **kwargs)
+
+            etag = __make_etag(version)
+            if request.if_none_match.contains(etag):
+                return Response(status=304, headers={"ETag": quote_etag(etag)})
+
+            return func(*args, **kwargs), 200, {"ETag": quote_etag(etag)}
+
+        return wrapper
+
+    return decorator
+
+
+# 同一版本下不同查詢參數或不同使用者之回應不可共用ETag
+def __make_etag(version):
+    raw = "|".join([request.full_path, request.headers.get("Authorization", ""), str(version)])
+    return hashlib.sha1(raw.encode("utf-8")).hexdigest()
@@ -0,0 +1,43 @@
+from app.service import resource_version_service
+from app.service.main_task_service import get_eq_task_partnumber_demand_list_by_main_task_id
+from app.util.version_cache import VersionCache
+
+EQ_TASK_DEMAND_ROLLUP_TTL_SECONDS = 30 * 60
+
+__eq_task_demand_rollup_cache = VersionCache(ttl_seconds=EQ_TASK_DEMAND_ROLLUP_TTL_SECONDS)
+
+
+# EQ主任務partnumber需求匯總之欄位陣列, 以主任務id快取並附帶EQ list內容版本號:
+# {"partnumber_id_column": (...), "function_column": (...), "demand_qty_column": (...)}
+# 版本號與資料庫不一致(其他進程已異動)時重新匯總, 同一版本只計算一次
+def get_eq_task_demand_rollup_by_main_task_id(main_task_id):
+    content_version = resource_version_service.get_main_task_version(main_task_id)
+    cached_version, demand_rollup = __eq_task_demand_rollup_cache.get_or_load(
+        main_task_id, lambda: (content_version, __build_eq_task_demand_rollup(main_task_id)))
+    if cached_version != content_version:
+        __eq_task_demand_rollup_cache.invalidate(main_task_id)
+        cached_version, demand_rollup = __eq_task_demand_rollup_cache.get_or_load(
+            main_task_id, lambda: (content_version, __build_eq_task_demand_rollup(main_task_id)))
+    return demand_rollup
+
+
+def invalidate_eq_task_demand_rollup(main_task_id=None):
+    __eq_task_demand_rollup_cache.invalidate(main_task_id)
+
+
+def __build_eq_task_demand_rollup(main_task_id):
+    partnumber_id_column = []
+    function_column = []
+    demand_qty_column = []
+    for pn_demand in get_eq_task_partnumber_demand_list_by_main_task_id(main_task_id):
+        _pn_id = pn_demand.get("partnumber").id
+        for _function_demand in pn_demand.get("function_demand_list"):
+            partnumber_id_column.append(_pn_id)
+            function_column.append(_function_demand['function'])
+            demand_qty_column.append(_function_demand['demand_qty'])
+    # 快取跨請求共用, 以tuple保存避免被呼叫端修改
+    return {
+        "partnumber_id_column": tuple(partnumber_id_column),
+        "function_column": tuple(function_column),
+        "demand_qty_column": tuple(demand_qty_column),
+    }
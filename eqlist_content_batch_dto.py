@@ -0,0 +1,28 @@
+from copy import deepcopy
+from flask_restx import fields
+from app.dto import base_resource_fields
+from app.dto.eqlist_content_dto import EQListContentDTO
+from app.util.pre_request import Rule
+
+
+class EQListContentBatchDTO(object):
+    api = EQListContentDTO.api
+
+    eqlist_content_batch_item_resp_dto = {
+        "index": fields.Integer(),
+        "eqlist_content_id": fields.Integer(),
+        "target_id": fields.Integer(),
+        "partnumber_count": fields.Integer(),
+    }
+
+    # req
+    add_eqlist_content_list_by_params_req = {
+        # 每筆以單筆新建之規則解析, 型別轉換/預設值/trim與單筆介面一致
+        "eqlist_content_list": Rule(type=dict, multi=True, required=True,
+                                    structure=EQListContentDTO.add_eqlist_content_by_params_req),
+    }
+
+    __eqlist_content_batch_resp_fields = deepcopy(base_resource_fields)
+    __eqlist_content_batch_resp_fields['result']['eqlist_content_list'] = fields.List(
+        fields.Nested(eqlist_content_batch_item_resp_dto))
+    eqlist_content_batch_resp_field_model = api.model('批量新建EQ回复内容', __eqlist_content_batch_resp_fields)
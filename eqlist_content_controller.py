@@ -1,6 +1,9 @@
 from app.dto import base_resource_fields, delete_success_resp
+from app.dto.eqlist_content_batch_dto import EQListContentBatchDTO
 from app.dto.eqlist_content_dto import EQListContentDTO
-from app.service import eqlist_content_service
+from app.dto.export_job_dto import ExportJobDTO
+from app.service import eqlist_content_service, resource_version_service
+from app.util.conditional_request import etag_conditional_get
 from app.util.api_base_resource import customResource
 from app.util.decorators import require_role
 from app.util.oauth_client import require_oauth
@@ -10,6 +13,14 @@ from app.util.pre_request import pre
 api = EQListContentDTO.api
 
 
+# ETag版本號: 缺少main_task_id時不做條件式GET, 交由參數校驗處理
+def _get_main_task_version_by_args(args):
+    main_task_id = args.get("main_task_id", type=int)
+    if main_task_id is None:
+        return None
+    return resource_version_service.get_main_task_record_etag_version(main_task_id)
+
+
 @api.route('')
 class EQListContent(customResource):
 
@@ -45,6 +56,20 @@ class EQListContent(customResource):
         return delete_success_resp
 
 
+@api.route('/batch')
+class EQListContentBatch(customResource):
+
+    @require_oauth('server')
+    @require_role(contains_any=[enum_role.DRI])
+    @api.marshal_with(EQListContentBatchDTO.eqlist_content_batch_resp_field_model)
+    @pre.catch(EQListContentBatchDTO.add_eqlist_content_list_by_params_req)
+    def post(self, params):
+        """
+            批量新建EQ回复内容
+        """
+        return {"eqlist_content_list": eqlist_content_service.add_eqlist_content_list_by_params(params)}
+
+
 @api.route('/file')
 class EQListContentFile(customResource):
 
@@ -58,11 +83,26 @@ class EQListContentFile(customResource):
         return eqlist_content_service.get_eqlist_file_by_params(params)
 
 
+@api.route('/file/job')
+class EQListContentFileJob(customResource):
+
+    @require_oauth('server')
+    @require_role(contains_any=[enum_role.LL])
+    @api.marshal_with(ExportJobDTO.export_job_resp_fields_model)
+    @pre.catch(EQListContentDTO.aggregate_by_station_eqlist_content_params_req)
+    def post(self, params):
+        """
+            提交EQlist文件匯出任務
+        """
+        return {"export_job": eqlist_content_service.submit_eqlist_file_export_job_by_params(params)}
+
+
 @api.route('/record')
 class EQListContentAggregation(customResource):
 
     @require_oauth('server')
     @require_role(contains_any=[enum_role.LL, enum_role.DRI, enum_role.MANAGER])
+    @etag_conditional_get(_get_main_task_version_by_args)
     @api.marshal_with(EQListContentDTO.eqlist_content_singal_record_resp_field_model)
     @pre.catch(EQListContentDTO.aggregate_by_station_eqlist_content_params_req)
     def get(self, params):
@@ -1,20 +1,27 @@
 import math
-from io import BytesIO
+import os
 
-import pandas as pd
-from sqlalchemy import func
+from sqlalchemy import bindparam
+from sqlalchemy.orm import joinedload
 
 from app import db
-from app.lib.excelLib import el
+from app.lib import excel_stream
+from app.model.base_bulk_model import get_audit_params, get_audit_update_params
 from app.model.connect_eqlist_content_partnumber_model import ConnectEQListContentPartnumber
 from app.model.eqlist_content_model import EQListContent
 from app.model.main_task_model import MainTask
 from app.model.partnumber_model import Partnumber
 from app.model.reply_target_model import ReplyTarget
+from app.model.small_line_model import SmallLine
 from app.model.station_model import Station
 from app.model.sub_task_model import SubTask
+from app.service import eq_task_demand_rollup_service, eqlist_station_aggregate_service, export_job_service, \
+    resource_version_service
+from app.util.api_exceptions import UnprocessableContentError, NotFoundError
 from app.util.pre_request.utils import _Missing
 
+EQLIST_CONTENT_PARTNUMBER_REQUIRED_KEY_LIST = ["partnumber_id", "ratio", "back_up_ratio"]
+
 
 def add_eqlist_content_by_params(params):
     _eqlist_content = EQListContent.add_model_by_params({
@@ -27,20 +34,97 @@ def add_eqlist_content_by_params(params):
         "function": params['function']
     })
 
-    for _partnumber_obj in params['partnumber_list']:
-        ConnectEQListContentPartnumber.add_model_by_params({
-            "eqlist_content_id": _eqlist_content.id,
-            "partnumber_id": _partnumber_obj['partnumber_id'],
-            "bom_ratio": _partnumber_obj['ratio'],
-            "backup_ratio": _partnumber_obj['back_up_ratio']
-        })
+    __bulk_insert_connect_eqlist_content_partnumber([{
+        "eqlist_content_id": _eqlist_content.id,
+        "partnumber_id": _partnumber_obj['partnumber_id'],
+        "bom_ratio": _partnumber_obj['ratio'],
+        "backup_ratio": _partnumber_obj['back_up_ratio']
+    } for _partnumber_obj in params['partnumber_list']])
+    db.session.expire(_eqlist_content, ['_station_bom_partnumbers'])
 
+    __apply_eqlist_station_aggregate_delta([], [_eqlist_content.id])
     db.session.commit()
     return _eqlist_content
 
 
+# 批量新建: 全部先校驗, 再於同一交易內批量寫入, 回傳逐筆結果
+def add_eqlist_content_list_by_params(params):
+    _eqlist_content_param_list = params['eqlist_content_list']
+    __validate_eqlist_content_param_list(_eqlist_content_param_list)
+
+    _eqlist_content_list = [EQListContent(
+        reply_target_id=_eqlist_content_param['target_id'],
+        station_bom_qty=_eqlist_content_param['bom_number'],
+        station_name=_eqlist_content_param['station_name'],
+        name=_eqlist_content_param['bom_name'],
+        uph=_eqlist_content_param['uph'],
+        priority=_eqlist_content_param['priority'],
+        function=_eqlist_content_param['function']
+    ) for _eqlist_content_param in _eqlist_content_param_list]
+    db.session.add_all(_eqlist_content_list)
+    db.session.flush()
+
+    __bulk_insert_connect_eqlist_content_partnumber([{
+        "eqlist_content_id": _eqlist_content.id,
+        "partnumber_id": _partnumber_obj['partnumber_id'],
+        "bom_ratio": _partnumber_obj['ratio'],
+        "backup_ratio": _partnumber_obj['back_up_ratio']
+    } for _eqlist_content, _eqlist_content_param in zip(_eqlist_content_list, _eqlist_content_param_list)
+        for _partnumber_obj in _eqlist_content_param['partnumber_list']])
+
+    __apply_eqlist_station_aggregate_delta([], [_eqlist_content.id for _eqlist_content in _eqlist_content_list])
+
+    db.session.commit()
+    return [{
+        "index": _index,
+        "eqlist_content_id": _eqlist_content.id,
+        "target_id": _eqlist_content_param['target_id'],
+        "partnumber_count": len(_eqlist_content_param['partnumber_list'])
+    } for _index, (_eqlist_content, _eqlist_content_param) in enumerate(zip(_eqlist_content_list, _eqlist_content_param_list))]
+
+
+# 各筆已由pre_request以單筆新建之規則解析(型別/預設值/trim與單筆介面一致), 此處只做跨筆與資料庫校驗, 錯誤訊息帶索引
+def __validate_eqlist_content_param_list(eqlist_content_param_list):
+    if len(eqlist_content_param_list) == 0:
+        raise UnprocessableContentError(msg=f'eqlist_content_list can not be empty')
+
+    for _index, _eqlist_content_param in enumerate(eqlist_content_param_list):
+        _path = f'eqlist_content_list[{_index}]'
+        if not isinstance(_eqlist_content_param.get('partnumber_list'), list):
+            raise UnprocessableContentError(msg=f'{_path}.partnumber_list must be list')
+        for _partnumber_index, _partnumber_obj in enumerate(_eqlist_content_param['partnumber_list']):
+            _partnumber_path = f'{_path}.partnumber_list[{_partnumber_index}]'
+            if not isinstance(_partnumber_obj, dict):
+                raise UnprocessableContentError(msg=f'{_partnumber_path} must be object')
+            _missing_key_list = [_key for _key in EQLIST_CONTENT_PARTNUMBER_REQUIRED_KEY_LIST
+                                 if _partnumber_obj.get(_key) is None]
+            if len(_missing_key_list) > 0:
+                raise UnprocessableContentError(msg=f'{_partnumber_path} missing {", ".join(_missing_key_list)}')
+        _partnumber_id_list = [_partnumber_obj['partnumber_id'] for _partnumber_obj in _eqlist_content_param['partnumber_list']]
+        if len(_partnumber_id_list) != len(set(_partnumber_id_list)):
+            raise UnprocessableContentError(msg=f'{_path}.partnumber_list has duplicate partnumber')
+
+    _reply_target_id_set = {_eqlist_content_param['target_id'] for _eqlist_content_param in eqlist_content_param_list}
+    _existed_reply_target_id_set = {_id for (_id,) in db.session.query(ReplyTarget.id)
+        .filter(ReplyTarget.id.in_(_reply_target_id_set)).all()}
+    if _reply_target_id_set != _existed_reply_target_id_set:
+        raise NotFoundError(msg=f'reply target {sorted(_reply_target_id_set - _existed_reply_target_id_set)} not found')
+
+    _partnumber_id_set = {_partnumber_obj['partnumber_id'] for _eqlist_content_param in eqlist_content_param_list
+                          for _partnumber_obj in _eqlist_content_param['partnumber_list']}
+    _existed_partnumber_id_set = {_id for (_id,) in db.session.query(Partnumber.id)
+        .filter(Partnumber.id.in_(_partnumber_id_set)).all()}
+    if _partnumber_id_set != _existed_partnumber_id_set:
+        raise NotFoundError(msg=f'partnumber {sorted(_partnumber_id_set - _existed_partnumber_id_set)} not found')
+
+
 def update_eqlist_content_by_params(params):
-    _eqlist_content = EQListContent.get_model_by_id(params['eqlist_content_id']).update_model_by_params({
+    # 先鎖定內容列再讀取, 之後之連結與貢獻皆為鎖定讀取, 與並行之修改不會混用不同視圖
+    eqlist_station_aggregate_service.lock_eqlist_content_list([params['eqlist_content_id']])
+    _eqlist_content = EQListContent.get_model_by_id(params['eqlist_content_id'])
+    _old_contribution_list = eqlist_station_aggregate_service.get_eqlist_content_aggregate_contribution_list(
+        [_eqlist_content.id])
+    _eqlist_content = _eqlist_content.update_model_by_params({
         "station_bom_qty": params['bom_number'],
         "station_name": params['station_name'],
         "name": params['bom_name'],
@@ -49,10 +133,16 @@ def update_eqlist_content_by_params(params):
         "function": params['function']
     })
     if params['partnumber_list'] != _Missing:
-        _partnumber_list = {_connectEQListContentPartnumber.partnumber_id: {
-            "ratio": _connectEQListContentPartnumber.bom_ratio,
-            "backup_ratio": _connectEQListContentPartnumber.backup_ratio
-        } for _connectEQListContentPartnumber in _eqlist_content._station_bom_partnumbers}
+        _partnumber_list = {_partnumber_id: {
+            "ratio": _bom_ratio,
+            "backup_ratio": _backup_ratio
+        } for _partnumber_id, _bom_ratio, _backup_ratio in db.session.query(
+            ConnectEQListContentPartnumber.partnumber_id,
+            ConnectEQListContentPartnumber.bom_ratio,
+            ConnectEQListContentPartnumber.backup_ratio)
+            .filter(ConnectEQListContentPartnumber.eqlist_content_id == _eqlist_content.id)
+            .with_for_update()
+            .all()}
 
         _req_partnumber_list = {_partnumber_obj['partnumber_id']: {
             "bom_ratio": _partnumber_obj['ratio'],
@@ -62,44 +152,95 @@ def update_eqlist_content_by_params(params):
         _remove_partnumber_list = list(set(_partnumber_list.keys()).difference(_req_partnumber_list.keys()))
         _add_partnumber_list = list(set(_req_partnumber_list.keys()).difference(_partnumber_list.keys()))
         _add_partnumber_dict = {k: v for k, v in _req_partnumber_list.items() if k in _add_partnumber_list}
-        _update_partnumber_dict = {k: v for k, v in _req_partnumber_list.items() if k not in _add_partnumber_list}
+        _update_partnumber_dict = {k: v for k, v in _req_partnumber_list.items()
+                                   if k not in _add_partnumber_list
+                                   and (v["bom_ratio"] != _partnumber_list[k]["ratio"]
+                                        or v["backup_ratio"] != _partnumber_list[k]["backup_ratio"])}
 
+        # 每種操作各一次round trip: DELETE ... IN / 批量INSERT / executemany UPDATE
         # remove
-        ConnectEQListContentPartnumber.delete_models_by_params({"eqlist_content_id": _eqlist_content.id, "partnumber_id": _remove_partnumber_list})
+        if len(_remove_partnumber_list) > 0:
+            db.session.execute(ConnectEQListContentPartnumber.__table__.delete().where(
+                (ConnectEQListContentPartnumber.eqlist_content_id == _eqlist_content.id)
+                & (ConnectEQListContentPartnumber.partnumber_id.in_(_remove_partnumber_list))))
 
         # add
-        for _add_partnumber_id, val in _add_partnumber_dict.items():
-            val['eqlist_content_id'] = _eqlist_content.id
-            val['partnumber_id'] = _add_partnumber_id
-            ConnectEQListContentPartnumber.add_model_by_params(val)
+        __bulk_insert_connect_eqlist_content_partnumber([dict(val, eqlist_content_id=_eqlist_content.id,
+                                                              partnumber_id=_add_partnumber_id)
+                                                         for _add_partnumber_id, val in _add_partnumber_dict.items()])
 
         # update
-        for _update_partnumber_id, val in _update_partnumber_dict.items():
-            ConnectEQListContentPartnumber.get_model_by_params({"eqlist_content_id": _eqlist_content.id, "partnumber_id": _update_partnumber_id}).update_model_by_params(val)
-
+        if len(_update_partnumber_dict) > 0:
+            _connect_table = ConnectEQListContentPartnumber.__table__
+            db.session.execute(
+                _connect_table.update()
+                    .where(_connect_table.c.eqlist_content_id == bindparam("b_eqlist_content_id"))
+                    .where(_connect_table.c.partnumber_id == bindparam("b_partnumber_id"))
+                    .values(bom_ratio=bindparam("b_bom_ratio"), backup_ratio=bindparam("b_backup_ratio"),
+                            **get_audit_update_params(_connect_table)),
+                [{
+                    "b_eqlist_content_id": _eqlist_content.id,
+                    "b_partnumber_id": _update_partnumber_id,
+                    "b_bom_ratio": val["bom_ratio"],
+                    "b_backup_ratio": val["backup_ratio"],
+                } for _update_partnumber_id, val in _update_partnumber_dict.items()])
+
+        db.session.expire(_eqlist_content, ['_station_bom_partnumbers'])
+
+    __apply_eqlist_station_aggregate_delta(_old_contribution_list, [_eqlist_content.id])
     db.session.commit()
     return _eqlist_content
 
 
 def delete_eqlist_content_by_params(params):
+    eqlist_station_aggregate_service.lock_eqlist_content_list([params['eqlist_content_id']])
+    _old_contribution_list = eqlist_station_aggregate_service.get_eqlist_content_aggregate_contribution_list(
+        [params['eqlist_content_id']])
     EQListContent.delete_model_by_id(params['eqlist_content_id'])
+    __apply_eqlist_station_aggregate_delta(_old_contribution_list, [params['eqlist_content_id']])
     db.session.commit()
 
 
+# Core批量INSERT不經createAndUpdateMixin, 稽核欄位顯式帶入
+def __bulk_insert_connect_eqlist_content_partnumber(connect_eqlist_content_partnumber_list):
+    if len(connect_eqlist_content_partnumber_list) > 0:
+        _connect_table = ConnectEQListContentPartnumber.__table__
+        audit_params = get_audit_params(_connect_table)
+        db.session.execute(_connect_table.insert(),
+                           [dict(_params, **audit_params) for _params in connect_eqlist_content_partnumber_list])
+
+
+# 異動flush後以與異動前相同之鎖定讀取取得新貢獻, 相減後增量累加至聚合表
+def __apply_eqlist_station_aggregate_delta(old_contribution_list, eqlist_content_id_list):
+    db.session.flush()
+    new_contribution_list = eqlist_station_aggregate_service.get_eqlist_content_aggregate_contribution_list(
+        eqlist_content_id_list)
+    eqlist_station_aggregate_service.apply_eqlist_station_aggregate_delta(old_contribution_list, new_contribution_list)
+
+    main_task_id_list = list({_contribution[0] for _contribution in old_contribution_list + new_contribution_list})
+    resource_version_service.bump_main_task_version(main_task_id_list)
+    for _main_task_id in main_task_id_list:
+        eq_task_demand_rollup_service.invalidate_eq_task_demand_rollup(_main_task_id)
+
+
 def aggregate_by_station_eqlist_content_by_params(params):
-    rst = MainTask._get_model_sql_by_params({"id": params['main_task_id']}) \
-        .join(SubTask) \
-        .join(ReplyTarget) \
-        .join(EQListContent) \
-        .join(ConnectEQListContentPartnumber) \
-        .with_entities(ReplyTarget.target_id,
-                       ConnectEQListContentPartnumber.partnumber_id,
-                       func.sum(EQListContent.station_bom_qty * ConnectEQListContentPartnumber.bom_ratio),
-                       func.sum(EQListContent.station_bom_qty * ConnectEQListContentPartnumber.bom_ratio * ConnectEQListContentPartnumber.backup_ratio)) \
-        .group_by(ReplyTarget.target_id, ConnectEQListContentPartnumber.partnumber_id) \
-        .all()
+    # 讀取維護中之站點聚合表, 不再即時五表join
+    rst = eqlist_station_aggregate_service.get_eqlist_station_aggregate_list_by_main_task_id(params['main_task_id'])
 
     # [(1, 2774, Decimal('15'), Decimal('30')), (1, 2775, Decimal('10'), Decimal('20'))]
+    # 聚合結果已含全部id, partnumber與station各以一條IN查詢載入
+    partnumber_by_id = {}
+    station_by_id = {}
+    if len(rst) > 0:
+        partnumber_by_id = {_partnumber.id: _partnumber for _partnumber in Partnumber.query.options(
+            joinedload(Partnumber._vendor_item),
+            joinedload(Partnumber._spec_item),
+            joinedload(Partnumber._station_item),
+        ).filter(Partnumber.id.in_({i[1] for i in rst})).all()}
+        station_by_id = {_station.id: _station for _station in Station.query.options(
+            joinedload(Station._small_line).joinedload(SmallLine._big_line),
+        ).filter(Station.id.in_({i[0] for i in rst})).all()}
+
     station_dict = {}
     for i in rst:
         station_id = i[0]
@@ -107,7 +248,7 @@ def aggregate_by_station_eqlist_content_by_params(params):
         need_qty = int(i[2])
         back_up_qty = int(i[3])
         parmas = {
-            "partnumber": Partnumber.get_model_by_id(partnumber_id),
+            "partnumber": partnumber_by_id.get(partnumber_id),
             "need_qty": need_qty,
             "back_up_qty": math.ceil(back_up_qty / 100)
         }
@@ -119,7 +260,7 @@ def aggregate_by_station_eqlist_content_by_params(params):
             station_dict[station_id].append(parmas)
 
     station_list = [{
-        "station": Station.get_model_by_id(k),
+        "station": station_by_id.get(k),
         "partnumber_list": v
     } for k, v in station_dict.items()]
 
@@ -151,50 +292,109 @@ def aggregate_by_big_line_eqlist_content_by_params(params):
     } for k, v in big_line_dict_list.items()]
 
 
+EXPORT_TYPE_EQLIST = "EQLIST"
+
+EQLIST_FILE_HEADER_LIST = [
+    "Team",
+    "Line",
+    "Station",
+    "Equipment(English)",
+    "Equipment(Chinese)",
+    "Vendor",
+    "Spec/Model/Drawing Number",
+    "Q'ty/Station",
+    "Station/Line",
+    "Line Q'ty",
+    "NeedQ'ty",
+    "Back Up Q'ty",
+    "Total Q'ty Demand",
+    "On-hand Q'ty",
+    "Delta",
+    "Dept.",
+    "Remark\n（治具/設備需要升級請在此欄位備註）",
+]
+
+
+def submit_eqlist_file_export_job_by_params(params):
+    return export_job_service.submit_export_job(EXPORT_TYPE_EQLIST, params)
+
+
 def get_eqlist_file_by_params(params):
+    file_path = excel_stream.make_temp_excel_file_path()
+    try:
+        file_name = write_eqlist_file_by_params(params, file_path)
+    except Exception:
+        os.remove(file_path)
+        raise
+    return excel_stream.make_streaming_excel_response(file_path, file_name)
+
+
+# 以write_only workbook逐列寫入暫存檔, 記憶體不隨列數增長, 回傳下載檔名; 有progress時回報已寫入列數
+def write_eqlist_file_by_params(params, file_path, progress=None):
     big_line_list = aggregate_by_big_line_eqlist_content_by_params(params)
     # [{'big_line': <BigLine 1>, 'station_list': [{'station': <Station 1>, 'partnumber_list': [{'partnumber': <Partnumber 2774>, 'need_qty': 5, 'back_up_qty': 10}]}]}, {'big_line': <BigLine 2>, 'station_list': [{'station': <Station 2>, 'partnumber_list': [{'partnumber': <Partnumber 2774>, 'need_qty': 10, 'back_up_qty': 20}, {'partnumber': <Partnumber 2775>, 'need_qty': 10, 'back_up_qty': 20}]}]}]
 
-    bio = BytesIO()
-    writer = pd.ExcelWriter(bio, engine="openpyxl")
+    on_row_written = None
+    if progress is not None:
+        progress.set_total_row_count(sum(len(staion_dict['partnumber_list']) for big_line_dict in big_line_list
+                                         for staion_dict in big_line_dict['station_list']))
+        on_row_written = progress.add_written_row_count
+
+    workbook = excel_stream.create_write_only_workbook()
 
     if len(big_line_list) == 0:
-        df = pd.DataFrame()
-        df.to_excel(writer, sheet_name="sheet")
-        writer.save()
+        workbook.create_sheet(title="sheet")
     else:
+        # 庫存每個產品與不重複partnumber只計算一次, 不隨站點列數重複計算
+        fx_code_partnumber_dict = {}
+        for big_line_dict in big_line_list:
+            fx_code_partnumber_dict.setdefault(big_line_dict['big_line']._phase._product.fx_code, {}).update(
+                {partnumber['partnumber'].id: partnumber['partnumber'] for staion_dict in big_line_dict['station_list']
+                 for partnumber in staion_dict['partnumber_list']})
+        non_defective_qty_dict = {
+            fx_code: {_pn_id: _pn.get_non_defective_qty_by_product_name(fx_code) for _pn_id, _pn in _partnumber_dict.items()}
+            for fx_code, _partnumber_dict in fx_code_partnumber_dict.items()}
+
         for big_line_dict in big_line_list:
             big_line = big_line_dict['big_line']
-            data_list = []
-            for staion_dict in big_line_dict['station_list']:
-                _station = staion_dict['station']
-                for partnumber in staion_dict['partnumber_list']:
-                    _partnumber = partnumber['partnumber']
-                    need_qty = partnumber['need_qty']
-                    back_up_qty = partnumber['back_up_qty']
-                    on_hand_qty = _partnumber.get_non_defective_qty_by_product_name(big_line._phase._product.fx_code)
-                    data_list.append({
-                        "Team": _station.function,
-                        "Line": _station._small_line.name,
-                        "Station": _station.display_name,
-                        "Equipment(English)": _partnumber.en_name,
-                        "Equipment(Chinese)": _partnumber.zh_name,
-                        "Vendor": _partnumber._vendor_item.item_name,
-                        "Spec/Model/Drawing Number": _partnumber._spec_item.item_name,
-                        "Q'ty/Station": need_qty,
-                        "Station/Line": 1,
-                        "Line Q'ty": 1,
-                        "NeedQ'ty": need_qty,
-                        "Back Up Q'ty": back_up_qty,
-                        "Total Q'ty Demand": need_qty + back_up_qty,
-                        "On-hand Q'ty": on_hand_qty,
-                        "Delta": on_hand_qty - (need_qty + back_up_qty),
-                        "Dept.": "NPI-HWTE",
-                        "Remark\n（治具/設備需要升級請在此欄位備註）": ""
-                    })
-            df = pd.DataFrame(data_list)
-            el.to_excel_auto_column_weight(df=df, writer=writer, sheet_name=big_line.floor)
-            writer.save()
-            # df.to_excel(writer, sheet_name=big_line.floor)
-    _main_task = MainTask.get_model_by_id({"id": params['main_task_id']})
-    return el.make_excel_response(bio, file_name=f"{_main_task._phase._product.fx_code} {_main_task._phase.name} Build FATP EQ List.xlsx")
+            excel_stream.append_write_only_sheet(
+                workbook, big_line.floor, EQLIST_FILE_HEADER_LIST,
+                __iter_eqlist_file_row(big_line_dict,
+                                       non_defective_qty_dict[big_line._phase._product.fx_code]),
+                on_row_written=on_row_written)
+    workbook.save(file_path)
+
+    _main_task = MainTask.get_model_by_id(params['main_task_id'])
+    return f"{_main_task._phase._product.fx_code} {_main_task._phase.name} Build FATP EQ List.xlsx"
+
+
+def __iter_eqlist_file_row(big_line_dict, non_defective_qty_dict):
+    for staion_dict in big_line_dict['station_list']:
+        _station = staion_dict['station']
+        for partnumber in staion_dict['partnumber_list']:
+            _partnumber = partnumber['partnumber']
+            need_qty = partnumber['need_qty']
+            back_up_qty = partnumber['back_up_qty']
+            on_hand_qty = non_defective_qty_dict[_partnumber.id]
+            yield [
+                _station.function,
+                _station._small_line.name,
+                _station.display_name,
+                _partnumber.en_name,
+                _partnumber.zh_name,
+                _partnumber._vendor_item.item_name,
+                _partnumber._spec_item.item_name,
+                need_qty,
+                1,
+                1,
+                need_qty,
+                back_up_qty,
+                need_qty + back_up_qty,
+                on_hand_qty,
+                on_hand_qty - (need_qty + back_up_qty),
+                "NPI-HWTE",
+                "",
+            ]
+
+
+export_job_service.register_export_writer(EXPORT_TYPE_EQLIST, write_eqlist_file_by_params)
@@ -0,0 +1,23 @@
+from sqlalchemy import UniqueConstraint
+
+from app import db
+from app.model import base_model
+from app.model.base_bulk_model import base_bulk_model
+
+
+class EQListStationAggregate(db.Model, base_model, base_bulk_model):
+    """
+        EQ list站點聚合: 以(main_task_id, station_id, partnumber_id)為鍵,
+        維護SUM(station_bom_qty * bom_ratio)與SUM(station_bom_qty * bom_ratio * backup_ratio)
+    """
+    __tablename__ = 'wms_eqlist_station_aggregate'
+    __table_args__ = (
+        UniqueConstraint("main_task_id", "station_id", "partnumber_id"),
+    )
+
+    id = db.Column(db.Integer, primary_key=True)
+    main_task_id = db.Column(db.ForeignKey("wms_main_task.id", ondelete="CASCADE"), nullable=False)
+    station_id = db.Column(db.Integer, nullable=False)
+    partnumber_id = db.Column(db.ForeignKey("wms_partnumber.id", ondelete="CASCADE"), nullable=False)
+    need_qty = db.Column(db.Numeric(20, 4), nullable=False, default=0)
+    backup_qty = db.Column(db.Numeric(20, 4), nullable=False, default=0)
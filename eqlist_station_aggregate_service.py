@@ -0,0 +1,162 @@
+import click
+from flask.cli import AppGroup
+from sqlalchemy import func, tuple_
+from sqlalchemy.dialects.mysql import insert as mysql_insert
+
+from app import db
+from app.model.connect_eqlist_content_partnumber_model import ConnectEQListContentPartnumber
+from app.model.eqlist_content_model import EQListContent
+from app.model.eqlist_station_aggregate_model import EQListStationAggregate
+from app.model.main_task_model import MainTask
+from app.model.reply_target_model import ReplyTarget
+from app.model.sub_task_model import SubTask
+
+AGGREGATE_COLUMN_NAME_LIST = ["main_task_id", "station_id", "partnumber_id", "need_qty", "backup_qty"]
+# 與need_qty/backup_qty之Numeric(20, 4)精度一致, 增量累加後可精確歸零
+AGGREGATE_QTY_SCALE = 4
+
+
+def __get_live_aggregate_query(main_task_id=None, station_id=None, partnumber_id_list=None, eqlist_content_id_list=None):
+    live_aggregate_query = db.session.query(
+        MainTask.id,
+        ReplyTarget.target_id,
+        ConnectEQListContentPartnumber.partnumber_id,
+        func.sum(EQListContent.station_bom_qty * ConnectEQListContentPartnumber.bom_ratio),
+        func.sum(EQListContent.station_bom_qty * ConnectEQListContentPartnumber.bom_ratio * ConnectEQListContentPartnumber.backup_ratio)) \
+        .select_from(MainTask) \
+        .join(SubTask) \
+        .join(ReplyTarget) \
+        .join(EQListContent) \
+        .join(ConnectEQListContentPartnumber)
+    if main_task_id is not None:
+        live_aggregate_query = live_aggregate_query.filter(MainTask.id == main_task_id)
+    if station_id is not None:
+        live_aggregate_query = live_aggregate_query.filter(ReplyTarget.target_id == station_id)
+    if partnumber_id_list is not None:
+        live_aggregate_query = live_aggregate_query.filter(
+            ConnectEQListContentPartnumber.partnumber_id.in_(partnumber_id_list))
+    if eqlist_content_id_list is not None:
+        live_aggregate_query = live_aggregate_query.filter(EQListContent.id.in_(eqlist_content_id_list))
+    return live_aggregate_query.group_by(MainTask.id, ReplyTarget.target_id, ConnectEQListContentPartnumber.partnumber_id)
+
+
+# 異動交易之第一條語句: 只鎖定wms_eqlist_content之列, 同一內容之並行修改於此排隊,
+# 不鎖定MainTask/SubTask/ReplyTarget, 同主任務下其他內容之異動與新增不受影響
+def lock_eqlist_content_list(eqlist_content_id_list):
+    eqlist_content_id_list = list(set(eqlist_content_id_list))
+    if len(eqlist_content_id_list) == 0:
+        return
+    db.session.query(EQListContent.id) \
+        .filter(EQListContent.id.in_(eqlist_content_id_list)) \
+        .with_for_update() \
+        .all()
+
+
+# 指定EQ回覆內容對聚合表之貢獻: [(main_task_id, station_id, partnumber_id, need_qty, backup_qty)]
+# 異動前後皆以同一鎖定讀取(current read)取得, 不受REPEATABLE READ快照影響, 兩次讀取之視圖一致;
+# 只鎖定內容與連結表之列
+def get_eqlist_content_aggregate_contribution_list(eqlist_content_id_list):
+    eqlist_content_id_list = list(set(eqlist_content_id_list))
+    if len(eqlist_content_id_list) == 0:
+        return []
+    return __get_live_aggregate_query(eqlist_content_id_list=eqlist_content_id_list) \
+        .with_for_update(of=[EQListContent, ConnectEQListContentPartnumber]) \
+        .all()
+
+
+# 增量套用: 以INSERT ... ON DUPLICATE KEY UPDATE need_qty = need_qty + VALUES(need_qty)累加新舊貢獻之差,
+# 並行交易各自只累加自身之差值, 不會互相覆蓋; 累加後歸零之鍵刪除
+def apply_eqlist_station_aggregate_delta(old_contribution_list, new_contribution_list):
+    delta_dict = {}
+    for _sign, _contribution_list in [(-1, old_contribution_list), (1, new_contribution_list)]:
+        for main_task_id, station_id, partnumber_id, need_qty, backup_qty in _contribution_list:
+            _delta = delta_dict.setdefault((main_task_id, station_id, partnumber_id), [0, 0])
+            _delta[0] += _sign * need_qty
+            _delta[1] += _sign * backup_qty
+
+    delta_param_list = [dict(zip(AGGREGATE_COLUMN_NAME_LIST, _key + (round(_delta[0], AGGREGATE_QTY_SCALE),
+                                                                      round(_delta[1], AGGREGATE_QTY_SCALE))))
+                        for _key, _delta in delta_dict.items()]
+    delta_param_list = [_param for _param in delta_param_list if _param["need_qty"] != 0 or _param["backup_qty"] != 0]
+    if len(delta_param_list) == 0:
+        return
+
+    _table = EQListStationAggregate.__table__
+    insert_stmt = mysql_insert(_table)
+    db.session.execute(insert_stmt.on_duplicate_key_update(
+        need_qty=_table.c.need_qty + insert_stmt.inserted.need_qty,
+        backup_qty=_table.c.backup_qty + insert_stmt.inserted.backup_qty), delta_param_list)
+
+    db.session.execute(_table.delete().where(
+        tuple_(_table.c.main_task_id, _table.c.station_id, _table.c.partnumber_id).in_(
+            [(_param["main_task_id"], _param["station_id"], _param["partnumber_id"]) for _param in delta_param_list])
+        & (_table.c.need_qty == 0)
+        & (_table.c.backup_qty == 0)))
+
+
+def get_eqlist_station_aggregate_list_by_main_task_id(main_task_id):
+    return db.session.query(EQListStationAggregate.station_id,
+                            EQListStationAggregate.partnumber_id,
+                            EQListStationAggregate.need_qty,
+                            EQListStationAggregate.backup_qty) \
+        .filter(EQListStationAggregate.main_task_id == main_task_id) \
+        .order_by(EQListStationAggregate.station_id, EQListStationAggregate.partnumber_id) \
+        .all()
+
+
+def rebuild_eqlist_station_aggregate(main_task_id=None):
+    delete_stmt = EQListStationAggregate.__table__.delete()
+    if main_task_id is not None:
+        delete_stmt = delete_stmt.where(EQListStationAggregate.main_task_id == main_task_id)
+    db.session.execute(delete_stmt)
+    db.session.execute(EQListStationAggregate.__table__.insert().from_select(
+        AGGREGATE_COLUMN_NAME_LIST, __get_live_aggregate_query(main_task_id).statement))
+    db.session.commit()
+
+
+# 比對聚合表與即時join之結果, 回傳不一致之鍵
+def check_eqlist_station_aggregate_consistency(main_task_id=None):
+    live_dict = {tuple(_row[:3]): (_row[3], _row[4]) for _row in __get_live_aggregate_query(main_task_id).all()}
+
+    stored_query = db.session.query(EQListStationAggregate.main_task_id,
+                                    EQListStationAggregate.station_id,
+                                    EQListStationAggregate.partnumber_id,
+                                    EQListStationAggregate.need_qty,
+                                    EQListStationAggregate.backup_qty)
+    if main_task_id is not None:
+        stored_query = stored_query.filter(EQListStationAggregate.main_task_id == main_task_id)
+    stored_dict = {tuple(_row[:3]): (_row[3], _row[4]) for _row in stored_query.all()}
+
+    mismatch_list = []
+    # 增量套用會刪除歸零之鍵, 缺少之鍵視為(0, 0)
+    for _key in set(live_dict.keys()).union(stored_dict.keys()):
+        if live_dict.get(_key, (0, 0)) != stored_dict.get(_key, (0, 0)):
+            mismatch_list.append({
+                "main_task_id": _key[0],
+                "station_id": _key[1],
+                "partnumber_id": _key[2],
+                "live": live_dict.get(_key),
+                "stored": stored_dict.get(_key),
+            })
+    return mismatch_list
+
+
+eqlist_station_aggregate_cli = AppGroup('eqlist-aggregate', help='EQ list站點聚合表維護')
+
+
+@eqlist_station_aggregate_cli.command('rebuild')
+@click.option('--main-task-id', type=int, default=None, help='只重建指定主任務, 預設全部')
+def rebuild_eqlist_station_aggregate_command(main_task_id):
+    rebuild_eqlist_station_aggregate(main_task_id)
+    click.echo('eqlist station aggregate rebuilt')
+
+
+@eqlist_station_aggregate_cli.command('check')
+@click.option('--main-task-id', type=int, default=None, help='只檢查指定主任務, 預設全部')
+def check_eqlist_station_aggregate_command(main_task_id):
+    mismatch_list = check_eqlist_station_aggregate_consistency(main_task_id)
+    for _mismatch in mismatch_list:
+        click.echo(_mismatch)
+    click.echo(f'{len(mismatch_list)} mismatch found')
+    if len(mismatch_list) > 0:
+        raise SystemExit(1)
@@ -0,0 +1,73 @@
+import os
+import re
+import tempfile
+from urllib.parse import quote
+
+from flask import Response
+from openpyxl import Workbook
+from openpyxl.utils import get_column_letter
+
+EXCEL_MIMETYPE = "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
+EXCEL_STREAM_CHUNK_SIZE = 64 * 1024
+EXCEL_MIN_COLUMN_WIDTH = 10
+EXCEL_MAX_SHEET_TITLE_LENGTH = 31
+EXCEL_SHEET_TITLE_INVALID_CHAR_PATTERN = re.compile(r"[\[\]:*?/\\]")
+EXCEL_DEFAULT_SHEET_TITLE = "Sheet"
+
+
+def make_temp_excel_file_path():
+    fd, file_path = tempfile.mkstemp(suffix=".xlsx")
+    os.close(fd)
+    return file_path
+
+
+def create_write_only_workbook():
+    """
+        openpyxl write_only模式: 列寫入後即序列化至暫存檔, 記憶體不隨列數增長
+    """
+    return Workbook(write_only=True)
+
+
+# 工作表名稱不可含 []:*?/\ , 不可以單引號開頭或結尾, 且不可為空
+def sanitize_sheet_title(sheet_name):
+    title = EXCEL_SHEET_TITLE_INVALID_CHAR_PATTERN.sub("_", str(sheet_name))
+    title = title[:EXCEL_MAX_SHEET_TITLE_LENGTH].strip("'").strip()
+    return title if title else EXCEL_DEFAULT_SHEET_TITLE
+
+
+# on_row_written: 每寫入一列資料後呼叫, 供匯出任務回報進度
+def append_write_only_sheet(workbook, sheet_name, header_list, row_iter, on_row_written=None):
+    sheet = workbook.create_sheet(title=sanitize_sheet_title(sheet_name))
+    # write_only模式須在寫入列之前設定欄寬, 以表頭長度估算
+    for _index, _header in enumerate(header_list, start=1):
+        header_width = max(len(_line) for _line in str(_header).split("\n"))
+        sheet.column_dimensions[get_column_letter(_index)].width = max(EXCEL_MIN_COLUMN_WIDTH, header_width + 2)
+    sheet.append(header_list)
+    for _row in row_iter:
+        sheet.append(_row)
+        if on_row_written is not None:
+            on_row_written()
+    return sheet
+
+
+def iter_file_chunks(file_path, delete_after=True, chunk_size=EXCEL_STREAM_CHUNK_SIZE):
+    try:
+        with open(file_path, "rb") as f:
+            while True:
+                chunk = f.read(chunk_size)
+                if not chunk:
+                    break
+                yield chunk
+    finally:
+        if delete_after and os.path.exists(file_path):
+            os.remove(file_path)
+
+
+def make_streaming_excel_response(file_path, file_name, delete_after=True):
+    return Response(iter_file_chunks(file_path, delete_after=delete_after),
+                    mimetype=EXCEL_MIMETYPE,
+                    direct_passthrough=True,
+                    headers={
+                        "Content-Disposition": f"attachment; filename*=UTF-8''{quote(file_name)}",
+                        "Content-Length": str(os.path.getsize(file_path)),
+                    })
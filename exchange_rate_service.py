@@ -0,0 +1,24 @@
+from app.model.budget_content_model import to_decimal
+from app.service import public_menu_service
+
+
+class ExchangeRateSnapshot(object):
+    """
+        匯率快照, 同一次同步內所有幣別共用同一份匯率, 每個幣別只查詢一次
+    """
+
+    def __init__(self):
+        self.__rate_dict = {}
+
+    def get_exchange_rate_to_usd(self, currency):
+        if currency not in self.__rate_dict:
+            self.__rate_dict[currency] = to_decimal(public_menu_service.get_exchange_rate_to_usd(currency))
+        return self.__rate_dict[currency]
+
+    def get_exchange_rate_dict(self, currency_list):
+        return {_currency: self.get_exchange_rate_to_usd(_currency) for _currency in currency_list}
+
+
+# 每次同步或背景任務各建立一份快照, 不跨請求共用, 其他進程修改之匯率於下一次同步即生效
+def new_exchange_rate_snapshot():
+    return ExchangeRateSnapshot()
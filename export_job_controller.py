@@ -0,0 +1,32 @@
+from app.dto.export_job_dto import ExportJobDTO
+from app.service import export_job_service
+from app.util.api_base_resource import customResource
+from app.util.oauth_client import require_oauth
+from app.util.pre_request import pre
+
+api = ExportJobDTO.api
+
+
+@api.route('')
+class ExportJob(customResource):
+
+    @require_oauth('server')
+    @api.marshal_with(ExportJobDTO.export_job_resp_fields_model)
+    @pre.catch(get=ExportJobDTO.get_export_job_req)
+    def get(self, params):
+        """
+            獲取匯出任務狀態
+        """
+        return {"export_job": export_job_service.get_export_job_by_id(params.get("job_id"))}
+
+
+@api.route('/file')
+class ExportJobFile(customResource):
+
+    @require_oauth('server')
+    @pre.catch(get=ExportJobDTO.get_export_job_req)
+    def get(self, params):
+        """
+            下載匯出任務檔案
+        """
+        return export_job_service.get_export_job_file_by_id(params.get("job_id"))
@@ -0,0 +1,28 @@
+from copy import deepcopy
+from flask_restx import Namespace, fields
+from app.dto import base_resource_fields, MyDateTimeFormat
+from app.util.pre_request import Rule
+
+
+class ExportJobDTO(object):
+    api = Namespace('匯出任務')
+
+    export_job_resp_dto = {
+        "job_id": fields.String(),
+        "type": fields.String(attribute='export_type'),
+        "status": fields.String(),
+        "progress": fields.Integer(),
+        "file_name": fields.String(),
+        "error_msg": fields.String(),
+        "created_time": MyDateTimeFormat(attribute='create_datetime'),
+        "finished_time": MyDateTimeFormat(attribute='finish_datetime'),
+    }
+
+    # req
+    get_export_job_req = {
+        "job_id": Rule(type=str, location='args', trim=True, required=True),
+    }
+
+    __export_job_resp_fields = deepcopy(base_resource_fields)
+    __export_job_resp_fields['result']['export_job'] = fields.Nested(export_job_resp_dto)
+    export_job_resp_fields_model = api.model('獲取匯出任務', __export_job_resp_fields)
@@ -0,0 +1,214 @@
+import json
+import os
+import tempfile
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+from flask import current_app
+
+from app import db
+from app.lib import excel_stream
+from app.util.api_exceptions import NotFoundError, UnprocessableContentError
+from app.util.current_user import current_user
+
+EXPORT_JOB_DIR = os.path.join(tempfile.gettempdir(), "wms_export_job")
+EXPORT_JOB_MAX_WORKERS = 2
+EXPORT_JOB_MAX_QUEUE_SIZE = 16
+EXPORT_JOB_RESULT_TTL_SECONDS = 60 * 60
+# 進度寫回磁碟之最小間隔, 避免每列寫一次json
+EXPORT_JOB_PROGRESS_SAVE_INTERVAL_SECONDS = 1
+
+EXPORT_JOB_STATUS_PENDING = "PENDING"
+EXPORT_JOB_STATUS_RUNNING = "RUNNING"
+EXPORT_JOB_STATUS_SUCCESS = "SUCCESS"
+EXPORT_JOB_STATUS_FAILED = "FAILED"
+
+# 匯出類型 -> writer(params, file_path, progress=None), writer寫入檔案並回傳下載檔名;
+# progress為ExportJobProgress, 同步下載時為None
+__export_writer_dict = {}
+__executor = ThreadPoolExecutor(max_workers=EXPORT_JOB_MAX_WORKERS, thread_name_prefix="export_job")
+__queue_semaphore = threading.BoundedSemaphore(EXPORT_JOB_MAX_QUEUE_SIZE)
+
+
+class ExportJob(object):
+    """
+        匯出任務, 狀態以json存於本機磁碟, 同機多個worker進程皆可查詢; 只有提交者(owner_account)可查詢及下載
+    """
+
+    def __init__(self, job_id, export_type, owner_account=None, status=EXPORT_JOB_STATUS_PENDING, file_name=None,
+                 error_msg=None, create_time=None, finish_time=None, total_row_count=None, written_row_count=0):
+        self.job_id = job_id
+        self.export_type = export_type
+        self.owner_account = owner_account
+        self.status = status
+        self.file_name = file_name
+        self.error_msg = error_msg
+        self.create_time = create_time if create_time is not None else time.time()
+        self.finish_time = finish_time
+        self.total_row_count = total_row_count
+        self.written_row_count = written_row_count
+
+    # 執行中以已寫入列數/總列數計算, 完成前最多99
+    @property
+    def progress(self):
+        if self.status in [EXPORT_JOB_STATUS_SUCCESS, EXPORT_JOB_STATUS_FAILED]:
+            return 100
+        if not self.total_row_count:
+            return 0
+        return min(99, self.written_row_count * 100 // self.total_row_count)
+
+    @property
+    def create_datetime(self):
+        return datetime.fromtimestamp(self.create_time)
+
+    @property
+    def finish_datetime(self):
+        if self.finish_time is None:
+            return None
+        return datetime.fromtimestamp(self.finish_time)
+
+    @property
+    def file_path(self):
+        return os.path.join(EXPORT_JOB_DIR, f"{self.job_id}.xlsx")
+
+    @property
+    def meta_path(self):
+        return os.path.join(EXPORT_JOB_DIR, f"{self.job_id}.json")
+
+    def is_owned_by(self, account):
+        return self.owner_account is not None and self.owner_account == account
+
+    def is_expired(self):
+        return time.time() - self.create_time > EXPORT_JOB_RESULT_TTL_SECONDS
+
+    def save(self):
+        tmp_meta_path = f"{self.meta_path}.tmp"
+        with open(tmp_meta_path, "w") as f:
+            json.dump({
+                "job_id": self.job_id,
+                "export_type": self.export_type,
+                "owner_account": self.owner_account,
+                "status": self.status,
+                "file_name": self.file_name,
+                "error_msg": self.error_msg,
+                "create_time": self.create_time,
+                "finish_time": self.finish_time,
+                "total_row_count": self.total_row_count,
+                "written_row_count": self.written_row_count,
+            }, f)
+        os.replace(tmp_meta_path, self.meta_path)
+
+    def remove(self):
+        for _path in [self.file_path, self.meta_path]:
+            if os.path.exists(_path):
+                os.remove(_path)
+
+    @classmethod
+    def load(cls, job_id):
+        meta_path = os.path.join(EXPORT_JOB_DIR, f"{os.path.basename(str(job_id))}.json")
+        if not os.path.exists(meta_path):
+            return None
+        with open(meta_path) as f:
+            return cls(**json.load(f))
+
+
+class ExportJobProgress(object):
+    """
+        writer回報進度: 先設定總列數, 每寫入一列累加, 依間隔寫回任務json
+    """
+
+    def __init__(self, export_job):
+        self.__export_job = export_job
+        self.__last_save_time = time.monotonic()
+
+    def set_total_row_count(self, total_row_count):
+        self.__export_job.total_row_count = total_row_count
+        self.__export_job.written_row_count = 0
+        self.__save()
+
+    def add_written_row_count(self, row_count=1):
+        self.__export_job.written_row_count += row_count
+        if time.monotonic() - self.__last_save_time >= EXPORT_JOB_PROGRESS_SAVE_INTERVAL_SECONDS:
+            self.__save()
+
+    def __save(self):
+        self.__export_job.save()
+        self.__last_save_time = time.monotonic()
+
+
+def register_export_writer(export_type, writer):
+    __export_writer_dict[export_type] = writer
+
+
+def submit_export_job(export_type, params):
+    writer = __export_writer_dict.get(export_type)
+    if writer is None:
+        raise UnprocessableContentError(msg=f'export type {export_type} is not supported')
+
+    purge_expired_export_job()
+    if not __queue_semaphore.acquire(blocking=False):
+        raise UnprocessableContentError(msg=f'export job queue is full, please retry later')
+
+    try:
+        os.makedirs(EXPORT_JOB_DIR, exist_ok=True)
+        export_job = ExportJob(job_id=uuid.uuid4().hex, export_type=export_type, owner_account=current_user.account)
+        export_job.save()
+        __executor.submit(__run_export_job, current_app._get_current_object(), export_job, writer, dict(params))
+    except Exception:
+        __queue_semaphore.release()
+        raise
+    return export_job
+
+
+# 非提交者一律視為不存在, 不透露他人任務是否存在
+def get_export_job_by_id(job_id):
+    export_job = ExportJob.load(job_id)
+    if export_job is None or export_job.is_expired() or not export_job.is_owned_by(current_user.account):
+        raise NotFoundError(msg=f'export job not found')
+    return export_job
+
+
+def get_export_job_file_by_id(job_id):
+    export_job = get_export_job_by_id(job_id)
+    if export_job.status != EXPORT_JOB_STATUS_SUCCESS:
+        raise UnprocessableContentError(msg=f'export job is not finished')
+    return excel_stream.make_streaming_excel_response(export_job.file_path, export_job.file_name, delete_after=False)
+
+
+def purge_expired_export_job():
+    if not os.path.isdir(EXPORT_JOB_DIR):
+        return
+    for _file_name in os.listdir(EXPORT_JOB_DIR):
+        if not _file_name.endswith(".json"):
+            continue
+        try:
+            export_job = ExportJob.load(_file_name[:-len(".json")])
+            if export_job is not None and export_job.is_expired():
+                export_job.remove()
+        except (OSError, ValueError):
+            continue
+
+
+def __run_export_job(app, export_job, writer, params):
+    try:
+        with app.app_context():
+            try:
+                export_job.status = EXPORT_JOB_STATUS_RUNNING
+                export_job.save()
+                export_job.file_name = writer(params, export_job.file_path, progress=ExportJobProgress(export_job))
+                export_job.status = EXPORT_JOB_STATUS_SUCCESS
+            except Exception as e:
+                app.logger.exception(f'export job {export_job.job_id} failed')
+                export_job.status = EXPORT_JOB_STATUS_FAILED
+                export_job.error_msg = str(e)
+                if os.path.exists(export_job.file_path):
+                    os.remove(export_job.file_path)
+            finally:
+                db.session.remove()
+            export_job.finish_time = time.time()
+            export_job.save()
+    finally:
+        __queue_semaphore.release()
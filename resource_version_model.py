@@ -0,0 +1,75 @@
+from sqlalchemy import UniqueConstraint, event, tuple_
+from sqlalchemy.dialects.mysql import insert as mysql_insert
+from sqlalchemy.orm import Session
+
+from app import db
+from app.model import base_model
+
+# 回應中內嵌之參考資料(partnumber/選單/站點線別/階段產品), 共用單一版本號
+RESOURCE_TYPE_REFERENCE = "REFERENCE"
+REFERENCE_RESOURCE_ID = 0
+REFERENCE_VERSION_SESSION_KEY = "reference_version"
+
+
+class ResourceVersion(db.Model, base_model):
+    """
+        資源版本號: 以(resource_type, resource_id)為鍵, 寫入路徑於同一交易內遞增,
+        供讀取端產生ETag
+    """
+    __tablename__ = 'wms_resource_version'
+    __table_args__ = (
+        UniqueConstraint("resource_type", "resource_id"),
+    )
+
+    id = db.Column(db.Integer, primary_key=True)
+    resource_type = db.Column(db.String(32), nullable=False)
+    resource_id = db.Column(db.Integer, nullable=False)
+    version = db.Column(db.BigInteger, nullable=False, default=1)
+
+    # connection: flush事件內須以當前flush之連線執行
+    @classmethod
+    def bump_version(cls, resource_type, resource_id_list, connection=None):
+        resource_id_list = sorted(set(resource_id_list))
+        if len(resource_id_list) == 0:
+            return
+        insert_stmt = mysql_insert(cls.__table__)
+        (connection if connection is not None else db.session).execute(
+            insert_stmt.on_duplicate_key_update(version=cls.__table__.c.version + 1),
+            [{"resource_type": resource_type, "resource_id": _resource_id, "version": 1}
+             for _resource_id in resource_id_list])
+
+    @classmethod
+    def get_version(cls, resource_type, resource_id):
+        return cls.get_version_list([(resource_type, resource_id)])[0]
+
+    # 多個版本號以一條查詢取得, 依傳入順序回傳, 不存在者為0
+    @classmethod
+    def get_version_list(cls, resource_key_list):
+        version_dict = {(_resource_type, _resource_id): _version for _resource_type, _resource_id, _version in
+                        db.session.query(cls.resource_type, cls.resource_id, cls.version)
+                            .filter(tuple_(cls.resource_type, cls.resource_id).in_(resource_key_list))
+                            .all()}
+        return [version_dict.get(_resource_key, 0) for _resource_key in resource_key_list]
+
+    # 參考資料版本號每個交易只查詢一次, 供逐列求值之屬性使用, 交易結束後重新查詢;
+    # 本交易已異動參考資料(尚未提交)時回傳None, 呼叫端不得以此快取
+    @classmethod
+    def get_reference_version(cls):
+        if REFERENCE_VERSION_SESSION_KEY not in db.session.info:
+            db.session.info[REFERENCE_VERSION_SESSION_KEY] = cls.get_version(RESOURCE_TYPE_REFERENCE,
+                                                                             REFERENCE_RESOURCE_ID)
+        return db.session.info[REFERENCE_VERSION_SESSION_KEY]
+
+    @classmethod
+    def mark_reference_modified(cls, session):
+        session.info[REFERENCE_VERSION_SESSION_KEY] = None
+
+    @classmethod
+    def forget_reference_version(cls, session):
+        session.info.pop(REFERENCE_VERSION_SESSION_KEY, None)
+
+
+@event.listens_for(Session, 'after_commit')
+@event.listens_for(Session, 'after_rollback')
+def reference_version_after_transaction_handler(session):
+    ResourceVersion.forget_reference_version(session)
@@ -0,0 +1,67 @@
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+
+from app.model.big_line_model import BigLine
+from app.model.partnumber_model import Partnumber
+from app.model.phase_model import Phase
+from app.model.product_model import Product
+from app.model.public_menu_model import PublicMenu
+from app.model.resource_version_model import ResourceVersion, RESOURCE_TYPE_REFERENCE, REFERENCE_RESOURCE_ID
+from app.model.small_line_model import SmallLine
+from app.model.station_model import Station
+
+RESOURCE_TYPE_BUDGET = "BUDGET"
+RESOURCE_TYPE_BUDGET_LIST = "BUDGET_LIST"
+RESOURCE_TYPE_MAIN_TASK = "MAIN_TASK"
+
+# 預算列表/選單不分預算, 共用單一版本號
+BUDGET_LIST_RESOURCE_ID = 0
+# partnumber之vendor/spec/station/category選單項目經關聯內嵌, 其模型亦須列入
+REFERENCE_MODEL_TUPLE = (Partnumber, Partnumber._vendor_item.property.mapper.class_, PublicMenu, Station, SmallLine,
+                         BigLine, Phase, Product)
+
+
+# 預算內容異動: 遞增各預算版本號
+def bump_budget_version(budget_id_list):
+    ResourceVersion.bump_version(RESOURCE_TYPE_BUDGET, budget_id_list)
+
+
+# 預算本身新增/修改/刪除/鎖定: 遞增預算列表版本號
+def bump_budget_list_version():
+    ResourceVersion.bump_version(RESOURCE_TYPE_BUDGET_LIST, [BUDGET_LIST_RESOURCE_ID])
+
+
+# EQ list回覆內容異動: 遞增主任務版本號
+def bump_main_task_version(main_task_id_list):
+    ResourceVersion.bump_version(RESOURCE_TYPE_MAIN_TASK, main_task_id_list)
+
+
+# EQ list回覆內容版本號, 供快取判斷來源是否異動
+def get_main_task_version(main_task_id):
+    return ResourceVersion.get_version(RESOURCE_TYPE_MAIN_TASK, main_task_id)
+
+
+# 以下為ETag版本號, 皆包含內嵌參考資料之版本號, 一條查詢取得
+
+def get_budget_content_list_etag_version(budget_id):
+    return tuple(ResourceVersion.get_version_list([(RESOURCE_TYPE_BUDGET, budget_id),
+                                                   (RESOURCE_TYPE_REFERENCE, REFERENCE_RESOURCE_ID)]))
+
+
+def get_budget_list_etag_version():
+    return tuple(ResourceVersion.get_version_list([(RESOURCE_TYPE_BUDGET_LIST, BUDGET_LIST_RESOURCE_ID),
+                                                   (RESOURCE_TYPE_REFERENCE, REFERENCE_RESOURCE_ID)]))
+
+
+def get_main_task_record_etag_version(main_task_id):
+    return tuple(ResourceVersion.get_version_list([(RESOURCE_TYPE_MAIN_TASK, main_task_id),
+                                                   (RESOURCE_TYPE_REFERENCE, REFERENCE_RESOURCE_ID)]))
+
+
+# 參考資料經ORM異動時, 每次flush遞增一次參考資料版本號
+@event.listens_for(Session, 'after_flush')
+def reference_after_flush_handler(session, flush_context):
+    if any(isinstance(_obj, REFERENCE_MODEL_TUPLE)
+           for _obj_set in [session.new, session.dirty, session.deleted] for _obj in _obj_set):
+        ResourceVersion.bump_version(RESOURCE_TYPE_REFERENCE, [REFERENCE_RESOURCE_ID], connection=session.connection())
+        ResourceVersion.mark_reference_modified(session)
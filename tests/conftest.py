@@ -0,0 +1,37 @@
+import os
+
+import pytest
+from sqlalchemy import event
+
+from app import create_app, db
+
+
+# 需連線測試資料庫(MySQL), 以WMS_CONFIG指定設定; 每個測試結束後rollback, 不留下資料
+@pytest.fixture(scope="session")
+def app():
+    app = create_app(os.environ.get("WMS_CONFIG", "testing"))
+    with app.app_context():
+        yield app
+
+
+@pytest.fixture
+def session(app):
+    yield db.session
+    db.session.rollback()
+    db.session.remove()
+
+
+@pytest.fixture
+def statement_counter(session):
+    """
+        以before_cursor_execute計數實際送出之SQL語句
+    """
+    statement_list = []
+
+    def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        statement_list.append(statement)
+
+    engine = db.engine
+    event.listen(engine, "before_cursor_execute", _before_cursor_execute)
+    yield statement_list
+    event.remove(engine, "before_cursor_execute", _before_cursor_execute)
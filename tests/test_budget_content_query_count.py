@@ -0,0 +1,78 @@
+from decimal import Decimal
+
+from flask_restx import marshal
+
+from app import db
+from app.dto.budget_dto import BudgetDTO
+from app.model.budget_content_model import BudgetContent
+from app.model.budget_demand_model import BudgetDemand
+from app.model.budget_model import Budget
+from app.model.partnumber_model import Partnumber
+from app.model.phase_model import Phase
+from app.model.product_model import Product
+from app.model.resource_version_model import ResourceVersion
+from app.service import budget_service
+from app.util.enums import enum_budget_type
+
+BUDGET_CONTENT_COUNT = 1000
+BUDGET_DEMAND_FUNCTION_LIST = ["FATP", "SMT"]
+# 詳情(含partnumber與選單項目/預算/階段/產品)一條JOIN + 需求selectinload每500筆一條 + 參考資料版本號一條
+EXPECTED_STATEMENT_COUNT = 1 + 2 + 1
+
+
+def __add_budget_with_content(session):
+    _item_class = Partnumber._vendor_item.property.mapper.class_
+    _item = _item_class(item_name="query-count-item")
+    _phase = Phase(name="query-count-phase", _product=Product(fx_code="QC"))
+    # 非初版且非追加之預算類型, 不需來源EQ任務與綁定初版預算
+    _budget_type = next(_type for _type in enum_budget_type
+                        if _type not in [enum_budget_type.PILOT, enum_budget_type.EXTRA])
+    _budget = Budget(name="query-count-budget", _phase=_phase, budget_type=_budget_type)
+    _partnumber_list = [Partnumber(en_name=f"query-count-{_index}",
+                                   zh_name=f"query-count-{_index}",
+                                   price=Decimal("1.5"),
+                                   currency="USD",
+                                   _vendor_item=_item,
+                                   _spec_item=_item,
+                                   _station_item=_item,
+                                   _asset_category_item=_item)
+                        for _index in range(BUDGET_CONTENT_COUNT)]
+    session.add(_budget)
+    session.add_all(_partnumber_list)
+    session.flush()
+
+    _budget_content_list = [BudgetContent(partnumber_id=_partnumber.id,
+                                          budget_id=_budget.id,
+                                          on_hand_qty=0,
+                                          unit_price=Decimal("1.5"),
+                                          unit_price_currency="USD",
+                                          exchange_rate_to_usd=Decimal("1"),
+                                          _budget_demand_list=[BudgetDemand(function=_function, demand_qty=1)
+                                                               for _function in BUDGET_DEMAND_FUNCTION_LIST])
+                            for _partnumber in _partnumber_list]
+    session.add_all(_budget_content_list)
+    session.flush()
+    return _budget
+
+
+def __reset_unit_of_work(session):
+    # 模擬新請求: 清空identity map與本交易之參考資料版本號
+    session.expunge_all()
+    ResourceVersion.forget_reference_version(session)
+
+
+def test_get_budget_content_query_count_is_fixed(session, statement_counter):
+    _budget = __add_budget_with_content(session)
+    budget_id = _budget.id
+
+    # 預熱選單/站點索引等進程內快取
+    __reset_unit_of_work(session)
+    marshal(budget_service.get_budget_content_by_params({"budget_id": budget_id}), BudgetDTO.budget_content_resp_dto)
+
+    __reset_unit_of_work(session)
+    statement_counter.clear()
+    budget_content_list = budget_service.get_budget_content_by_params({"budget_id": budget_id})
+    rst = marshal(budget_content_list, BudgetDTO.budget_content_resp_dto)
+
+    assert len(rst) == BUDGET_CONTENT_COUNT
+    assert len(statement_counter) == EXPECTED_STATEMENT_COUNT, statement_counter
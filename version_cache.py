@@ -0,0 +1,66 @@
+import threading
+import time
+
+
+class VersionCache(object):
+    """
+        進程內快取, 以版本號整體失效, 可選TTL
+    """
+
+    def __init__(self, ttl_seconds=None):
+        self.__lock = threading.RLock()
+        self.__ttl_seconds = ttl_seconds
+        self.__version = 0
+        self.__entry_dict = {}
+
+    @property
+    def version(self):
+        return self.__version
+
+    def get_or_load(self, key, loader):
+        with self.__lock:
+            entry = self.__entry_dict.get(key)
+            if entry is not None and not self.__is_expired(entry):
+                return entry[2]
+            version = self.__version
+
+        value = loader()
+
+        with self.__lock:
+            # 載入期間若已失效則不寫回, 避免舊資料覆蓋
+            if version == self.__version:
+                self.__entry_dict[key] = (version, time.monotonic(), value)
+        return value
+
+    def get_or_load_by_version(self, key, version, loader):
+        """
+            以外部版本號(如資料庫之版本號)判斷, 快取之版本號與傳入不同時重新載入, 不依賴本進程之失效事件;
+            以讀取資料前取得之版本號標記, 載入期間之新提交至多使下次請求多載入一次; version為None時不快取
+        """
+        if version is None:
+            return loader()
+        with self.__lock:
+            entry = self.__entry_dict.get(key)
+            if entry is not None and not self.__is_expired(entry) and entry[2][0] == version:
+                return entry[2][1]
+            cache_version = self.__version
+
+        value = loader()
+
+        with self.__lock:
+            if cache_version == self.__version:
+                self.__entry_dict[key] = (cache_version, time.monotonic(), (version, value))
+        return value
+
+    def invalidate(self, key=None):
+        with self.__lock:
+            if key is None:
+                self.__version += 1
+                self.__entry_dict.clear()
+            else:
+                self.__entry_dict.pop(key, None)
+
+    def __is_expired(self, entry):
+        if entry[0] != self.__version:
+            return True
+        return self.__ttl_seconds is not None and time.monotonic() - entry[1] > self.__ttl_seconds